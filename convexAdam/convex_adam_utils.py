@@ -0,0 +1,708 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import os
+import sys
+import math
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evaluation'))
+from profiling import stage
+
+
+def gpu_usage():
+    print('gpu usage (current/max): {:.2f} / {:.2f} GB'.format(torch.cuda.memory_allocated()*1e-9, torch.cuda.max_memory_allocated()*1e-9))
+
+
+def pdist_squared(x):
+    xx = (x**2).sum(dim=1).unsqueeze(2)
+    yy = xx.permute(0, 2, 1)
+    dist = xx + yy - 2.0 * torch.bmm(x.permute(0, 2, 1), x)
+    dist[dist != dist] = 0
+    dist = torch.clamp(dist, 0.0, np.inf)
+    return dist
+    
+def MINDSSC(img, radius=2, dilation=2):
+    # see http://mpheinrich.de/pub/miccai2013_943_mheinrich.pdf for details on the MIND-SSC descriptor
+    
+    # kernel size
+    kernel_size = radius * 2 + 1
+    
+    # define start and end locations for self-similarity pattern
+    six_neighbourhood = torch.Tensor([[0,1,1],
+                                      [1,1,0],
+                                      [1,0,1],
+                                      [1,1,2],
+                                      [2,1,1],
+                                      [1,2,1]]).long()
+    
+    # squared distances
+    dist = pdist_squared(six_neighbourhood.t().unsqueeze(0)).squeeze(0)
+    
+    # define comparison mask
+    x, y = torch.meshgrid(torch.arange(6), torch.arange(6),indexing='ij')
+    mask = ((x > y).view(-1) & (dist == 2).view(-1))
+    
+    # build kernel
+    idx_shift1 = six_neighbourhood.unsqueeze(1).repeat(1,6,1).view(-1,3)[mask,:]
+    idx_shift2 = six_neighbourhood.unsqueeze(0).repeat(6,1,1).view(-1,3)[mask,:]
+    mshift1 = torch.zeros(12, 1, 3, 3, 3).cuda()
+    mshift1.view(-1)[torch.arange(12) * 27 + idx_shift1[:,0] * 9 + idx_shift1[:, 1] * 3 + idx_shift1[:, 2]] = 1
+    mshift2 = torch.zeros(12, 1, 3, 3, 3).cuda()
+    mshift2.view(-1)[torch.arange(12) * 27 + idx_shift2[:,0] * 9 + idx_shift2[:, 1] * 3 + idx_shift2[:, 2]] = 1
+    rpad1 = nn.ReplicationPad3d(dilation)
+    rpad2 = nn.ReplicationPad3d(radius)
+    
+    # compute patch-ssd
+    ssd = F.avg_pool3d(rpad2((F.conv3d(rpad1(img), mshift1, dilation=dilation) - F.conv3d(rpad1(img), mshift2, dilation=dilation)) ** 2), kernel_size, stride=1)
+    
+    # MIND equation
+    mind = ssd - torch.min(ssd, 1, keepdim=True)[0]
+    mind_var = torch.mean(mind, 1, keepdim=True)
+    mind_var = torch.clamp(mind_var, mind_var.mean()*0.001, mind_var.mean()*1000)
+    mind /= mind_var
+    mind = torch.exp(-mind)
+    
+    #permute to have same ordering as C++ code
+    mind = mind[:, torch.Tensor([6, 8, 1, 11, 2, 10, 0, 7, 9, 4, 5, 3]).long(), :, :, :]
+    
+    return mind
+
+
+#correlation layer: dense discretised displacements to compute SSD cost volume with box-filter
+def correlate(mind_fix,mind_mov,disp_hw,grid_sp,shape):
+    H = int(shape[0]); W = int(shape[1]); D = int(shape[2]);
+    C = int(mind_fix.shape[1])
+    with torch.no_grad():
+        mind_unfold = F.unfold(F.pad(mind_mov,(disp_hw,disp_hw,disp_hw,disp_hw,disp_hw,disp_hw)).squeeze(0),disp_hw*2+1)
+        mind_unfold = mind_unfold.view(C,-1,(disp_hw*2+1)**2,W//grid_sp,D//grid_sp)
+        
+
+    ssd = torch.zeros((disp_hw*2+1)**3,H//grid_sp,W//grid_sp,D//grid_sp,dtype=mind_fix.dtype, device=mind_fix.device)#.cuda().half()
+    ssd_argmin = torch.zeros(H//grid_sp,W//grid_sp,D//grid_sp).long()
+    with torch.no_grad():
+        for i in range(disp_hw*2+1):
+            mind_sum = (mind_fix.permute(1,2,0,3,4)-mind_unfold[:,i:i+H//grid_sp]).pow(2).sum(0,keepdim=True)
+            #5,stride=1,padding=2
+            #3,stride=1,padding=1
+            ssd[i::(disp_hw*2+1)] = F.avg_pool3d(F.avg_pool3d(mind_sum.transpose(2,1),3,stride=1,padding=1),3,stride=1,padding=1).squeeze(1)
+        ssd = ssd.view(disp_hw*2+1,disp_hw*2+1,disp_hw*2+1,H//grid_sp,W//grid_sp,D//grid_sp).transpose(1,0).reshape((disp_hw*2+1)**3,H//grid_sp,W//grid_sp,D//grid_sp)
+        ssd_argmin = torch.argmin(ssd,0)#
+        #ssd = F.softmax(-ssd*1000,0)
+    return ssd,ssd_argmin
+
+#solve two coupled convex optimisation problems for efficient global regularisation
+def coupled_convex(ssd,ssd_argmin,disp_mesh_t,grid_sp,shape,coeffs=(0.003,0.01,0.03,0.1,0.3,1)):
+    H = int(shape[0]); W = int(shape[1]); D = int(shape[2]);
+
+    disp_soft = F.avg_pool3d(disp_mesh_t.view(3,-1)[:,ssd_argmin.view(-1)].reshape(1,3,H//grid_sp,W//grid_sp,D//grid_sp),3,padding=1,stride=1)
+
+    coeffs = torch.tensor(coeffs)
+    for j in range(len(coeffs)):
+        ssd_coupled_argmin = torch.zeros_like(ssd_argmin)
+        with torch.no_grad():
+            for i in range(H//grid_sp):
+
+                coupled = ssd[:,i,:,:]+coeffs[j]*(disp_mesh_t-disp_soft[:,:,i].view(3,1,-1)).pow(2).sum(0).view(-1,W//grid_sp,D//grid_sp)
+                ssd_coupled_argmin[i] = torch.argmin(coupled,0)
+            #print(coupled.shape)
+
+        disp_soft = F.avg_pool3d(disp_mesh_t.view(3,-1)[:,ssd_coupled_argmin.view(-1)].reshape(1,3,H//grid_sp,W//grid_sp,D//grid_sp),3,padding=1,stride=1)
+
+    return disp_soft
+
+def grid_neighbours(cells, size):
+    # indices of the 3x3x3 neighbourhood of every active cell within the list of active cells,
+    # neighbours outside the grid or not active point to the sentinel index len(cells)
+    h, w, d = size
+    M = cells.shape[0]
+    device = cells.device
+    lookup = torch.full((h*w*d,), M, dtype=torch.long, device=device)
+    lookup[cells] = torch.arange(M, device=device)
+    shifts = torch.stack(torch.meshgrid(torch.arange(-1,2),torch.arange(-1,2),torch.arange(-1,2),indexing='ij')).view(3,1,27).to(device)
+    nh = (cells // (w*d)).view(1,-1,1) + shifts[0:1]
+    nw = ((cells // d) % w).view(1,-1,1) + shifts[1:2]
+    nd = (cells % d).view(1,-1,1) + shifts[2:3]
+    valid = ((nh>=0)&(nh<h)&(nw>=0)&(nw<w)&(nd>=0)&(nd<d)).squeeze(0)
+    neighbours = lookup[((nh.clamp(0,h-1)*w + nw.clamp(0,w-1))*d + nd.clamp(0,d-1)).squeeze(0)]
+    neighbours[~valid] = M
+    return neighbours
+
+#sparse correlation layer: SSD cost volume only for the grid cells inside the mask (compact list of active cells),
+#with centre (1,3,H//grid_sp,W//grid_sp,D//grid_sp) in grid cells the search window of every cell is shifted by this displacement
+def correlate_sparse(mind_fix,mind_mov,mask,disp_mesh_t,disp_hw,grid_sp,shape,chunk_size=64,centre=None):
+    H = int(shape[0])//grid_sp; W = int(shape[1])//grid_sp; D = int(shape[2])//grid_sp;
+    C = int(mind_fix.shape[1])
+    with torch.no_grad():
+        # the two 3x3x3 box filters need the ssd of all cells up to two cells away from the mask
+        mask_dil = F.max_pool3d(mask.float().view(1,1,H,W,D),5,stride=1,padding=2) > 0
+        cells_dil = torch.nonzero(mask_dil.view(-1)).view(-1)
+        M = cells_dil.shape[0]
+        neighbours_dil = grid_neighbours(cells_dil,(H,W,D))
+        
+        offsets = disp_mesh_t.view(3,-1).float().round().long()
+        L = offsets.shape[1]
+        feat_fix = mind_fix.reshape(C,-1)[:,cells_dil].t().unsqueeze(0)
+        # last column is the zero sentinel used by the neighbour table
+        ssd = torch.zeros(L,M+1,dtype=mind_fix.dtype,device=mind_fix.device)
+        if centre is None:
+            S0 = (W+2*disp_hw)*(D+2*disp_hw); S1 = D+2*disp_hw
+            base = ((cells_dil//(W*D)+disp_hw)*S0 + ((cells_dil//D)%W+disp_hw)*S1 + cells_dil%D+disp_hw).view(1,-1)
+            offsets = (offsets[0]*S0 + offsets[1]*S1 + offsets[2]).view(-1,1)
+            # channels last so that every gathered descriptor is contiguous
+            mind_pad = F.pad(mind_mov,(disp_hw,disp_hw,disp_hw,disp_hw,disp_hw,disp_hw)).view(C,-1).t().contiguous()
+            for l1 in range(0,L,chunk_size):
+                l2 = min(l1+chunk_size,L)
+                ssd[l1:l2,:M] = (feat_fix-mind_pad[base+offsets[l1:l2]]).pow(2).sum(2)
+        else:
+            # mind_mov sampled trilinearly at cell+centre+label, zeros outside as with the padding above
+            cells_hwd = torch.stack((cells_dil//(W*D),(cells_dil//D)%W,cells_dil%D)).float()+centre.view(3,-1)[:,cells_dil].float()
+            scale = torch.tensor([H-1,W-1,D-1],device=mind_fix.device).view(3,1,1).float()/2
+            for l1 in range(0,L,chunk_size):
+                l2 = min(l1+chunk_size,L)
+                grid = ((cells_hwd.unsqueeze(1)+offsets[:,l1:l2].unsqueeze(2).float())/scale-1).flip(0).permute(1,2,0).unsqueeze(0).unsqueeze(3)
+                mind_warped = F.grid_sample(mind_mov.float(),grid,align_corners=True)[0,:,:,:,0].permute(1,2,0)
+                ssd[l1:l2,:M] = (feat_fix.float()-mind_warped).pow(2).sum(2).to(ssd.dtype)
+        # two separable 3x3x3 box filters (left/centre/right neighbours along H, W and D)
+        for _ in range(2):
+            for k in [(4,22),(10,16),(12,14)]:
+                ssd_smooth = torch.zeros_like(ssd)
+                ssd_smooth[:,:M] = (ssd[:,:M]+ssd[:,neighbours_dil[:,k[0]]]+ssd[:,neighbours_dil[:,k[1]]])/3
+                ssd = ssd_smooth
+        
+        active = mask.view(-1)[cells_dil]
+        ssd = ssd[:,:M][:,active]
+        cells = cells_dil[active]
+    return ssd,cells
+
+#dense cost volume (as correlate) with the search window of every cell centred on the displacement centre
+#(1,3,H//grid_sp,W//grid_sp,D//grid_sp) in grid cells; the 3x3x3 box filters of correlate_sparse on all cells equal avg_pool3d
+def correlate_centred(mind_fix,mind_mov,centre,disp_mesh_t,disp_hw,grid_sp,shape):
+    H = int(shape[0])//grid_sp; W = int(shape[1])//grid_sp; D = int(shape[2])//grid_sp;
+    with torch.no_grad():
+        mask = torch.ones(1,1,H,W,D,dtype=torch.bool,device=mind_fix.device)
+        ssd,_ = correlate_sparse(mind_fix,mind_mov,mask,disp_mesh_t,disp_hw,grid_sp,shape,centre=centre)
+        ssd = ssd.view(-1,H,W,D)
+        ssd_argmin = torch.argmin(ssd,0)
+    return ssd,ssd_argmin
+
+#coupled convex optimisation on the compact list of active cells, smoothing over active neighbours only
+def coupled_convex_sparse(ssd,cells,disp_mesh_t,grid_sp,shape,coeffs=(0.003,0.01,0.03,0.1,0.3,1),chunk_size=4096):
+    H = int(shape[0])//grid_sp; W = int(shape[1])//grid_sp; D = int(shape[2])//grid_sp;
+    M = cells.shape[0]
+    neighbours = grid_neighbours(cells,(H,W,D))
+    count = (neighbours<M).sum(1).view(1,-1).to(ssd.dtype)
+    disp_cand = disp_mesh_t.view(3,-1)
+    
+    def smooth_disp(argmin):
+        disp = torch.cat((disp_cand[:,argmin],torch.zeros(3,1,dtype=disp_cand.dtype,device=disp_cand.device)),1)
+        return disp[:,neighbours].sum(2)/count
+    
+    disp_soft = smooth_disp(torch.argmin(ssd,0))
+    
+    coeffs = torch.tensor(coeffs)
+    for j in range(len(coeffs)):
+        ssd_coupled_argmin = torch.zeros(M,dtype=torch.long,device=ssd.device)
+        with torch.no_grad():
+            for m1 in range(0,M,chunk_size):
+                m2 = min(m1+chunk_size,M)
+                coupled = ssd[:,m1:m2]+coeffs[j]*(disp_cand.view(3,-1,1)-disp_soft[:,m1:m2].view(3,1,-1)).pow(2).sum(0)
+                ssd_coupled_argmin[m1:m2] = torch.argmin(coupled,0)
+        disp_soft = smooth_disp(ssd_coupled_argmin)
+    
+    disp_dense = torch.zeros(3,H*W*D,dtype=disp_soft.dtype,device=disp_soft.device)
+    disp_dense[:,cells] = disp_soft
+    return disp_dense.view(1,3,H,W,D)
+
+#enforce inverse consistency of forward and backward transform
+def inverse_consistency(disp_field1s,disp_field2s,iter=20):
+    #factor = 1
+    B,C,H,W,D = disp_field1s.size()
+    #make inverse consistent
+    with torch.no_grad():
+        disp_field1i = disp_field1s.clone()
+        disp_field2i = disp_field2s.clone()
+
+        identity = F.affine_grid(torch.eye(3,4).unsqueeze(0),(1,1,H,W,D)).permute(0,4,1,2,3).to(disp_field1s.device).to(disp_field1s.dtype)
+        for i in range(iter):
+            disp_field1s = disp_field1i.clone()
+            disp_field2s = disp_field2i.clone()
+
+            disp_field1i = 0.5*(disp_field1s-F.grid_sample(disp_field2s,(identity+disp_field1s).permute(0,2,3,4,1)))
+            disp_field2i = 0.5*(disp_field2s-F.grid_sample(disp_field1s,(identity+disp_field2s).permute(0,2,3,4,1)))
+
+    return disp_field1i,disp_field2i
+
+def combineDeformation3d(disp_1st,disp_2nd,identity):
+    disp_composition = disp_2nd + F.grid_sample(disp_1st,disp_2nd.permute(0,2,3,4,1)+identity)
+    return disp_composition
+
+def kpts_pt(kpts_world, shape):
+    device = kpts_world.device
+    H, W, D = shape
+    return (kpts_world.flip(-1) / (torch.tensor([D, W, H]).to(device) - 1)) * 2 - 1
+
+def kpts_world(kpts_pt, shape):
+    device = kpts_pt.device
+    H, W, D = shape
+    return ((kpts_pt.flip(-1) + 1) / 2) * (torch.tensor([H, W, D]).to(device) - 1)
+
+class TPS:
+    @staticmethod
+    def fit(c, f, lambd=0.):
+        device = c.device
+        
+        n = c.shape[0]
+        f_dim = f.shape[1]
+
+        U = TPS.u(TPS.d(c, c))
+        K = U + torch.eye(n, device=device) * lambd
+
+        P = torch.ones((n, 4), device=device)
+        P[:, 1:] = c
+
+        v = torch.zeros((n+4, f_dim), device=device)
+        v[:n, :] = f
+
+        A = torch.zeros((n+4, n+4), device=device)
+        A[:n, :n] = K
+        A[:n, -4:] = P
+        A[-4:, :n] = P.t()
+
+        theta = torch.linalg.solve(A, v)
+        return theta
+        
+    @staticmethod
+    def d(a, b):
+        ra = (a**2).sum(dim=1).view(-1, 1)
+        rb = (b**2).sum(dim=1).view(1, -1)
+        dist = ra + rb - 2.0 * torch.mm(a, b.permute(1, 0))
+        dist.clamp_(0.0, float('inf'))
+        return torch.sqrt(dist)
+
+    @staticmethod
+    def u(r):
+        return (r**2) * torch.log(r + 1e-6)
+
+    @staticmethod
+    def z(x, c, theta):
+        U = TPS.u(TPS.d(x, c))
+        w, a = theta[:-4], theta[-4:].unsqueeze(2)
+        b = torch.matmul(U, w)
+        return (a[0] + a[1] * x[:, 0] + a[2] * x[:, 1] + a[3] * x[:, 2] + b.t()).t()
+    
+def thin_plate_dense(x1, y1, shape, step, lambd=.0, unroll_step_size=2**12, num_points=None):
+    device = x1.device
+    D, H, W = shape
+    D1, H1, W1 = D//step, H//step, W//step
+    
+    # subsample control points to keep the (n+4)x(n+4) system small
+    if num_points is not None and x1.shape[1] > num_points:
+        idx = torch.randperm(x1.shape[1], device=device)[:num_points]
+        x1 = x1[:, idx]
+        y1 = y1[:, idx]
+    
+    x2 = F.affine_grid(torch.eye(3, 4, device=device).unsqueeze(0), (1, 1, D1, H1, W1), align_corners=True).view(-1, 3)
+    tps = TPS()
+    theta = tps.fit(x1[0], y1[0], lambd)
+    
+    y2 = torch.zeros((1, D1 * H1 * W1, 3), device=device)
+    N = D1*H1*W1
+    n = math.ceil(N/unroll_step_size)
+    for j in range(n):
+        j1 = j * unroll_step_size
+        j2 = min((j + 1) * unroll_step_size, N)
+        y2[0, j1:j2, :] = tps.z(x2[j1:j2], x1[0], theta)
+        
+    y2 = y2.view(1, D1, H1, W1, 3).permute(0, 4, 1, 2, 3)
+    y2 = F.interpolate(y2, (D, H, W), mode='trilinear', align_corners=True).permute(0, 2, 3, 4, 1)
+    
+    return y2
+
+
+def filter1D(img, weight, dim):
+    # separable 1D filtering with replicate padding along spatial dimension dim (0,1,2)
+    B, C, H, W, D = img.shape
+    N = weight.shape[0]
+    size = [1, 1, 1]
+    size[dim] = N
+    padding = [0, 0, 0, 0, 0, 0]
+    padding[4 - 2 * dim] = N // 2
+    padding[5 - 2 * dim] = N // 2
+    kernel = weight.to(img.dtype).view(1, 1, *size)
+    return F.conv3d(F.pad(img.view(B * C, 1, H, W, D), padding, mode='replicate'), kernel).view(B, C, H, W, D)
+
+def smooth(img, sigma):
+    N = int(math.ceil(sigma * 3.0)) * 2 + 1
+    weight = torch.exp(-torch.linspace(-(N // 2), N // 2, N, device=img.device).pow(2) / (2 * sigma ** 2))
+    weight /= weight.sum()
+    for dim in range(3):
+        img = filter1D(img, weight, dim)
+    return img
+
+def foerstner_kpts(img, mask, sigma=1.4, d=9, num_kpts=4096):
+    # distinctive points (Foerstner operator) inside the mask with non-maximum suppression in a d^3 window
+    # returns voxel coordinates (1,N,3) in (H,W,D) ordering
+    device = img.device
+    grad_filt = torch.tensor([-0.5, 0.0, 0.5], device=device)
+    grad = torch.cat([filter1D(img, grad_filt, dim) for dim in range(3)], 1)
+    
+    # structure tensor (xx,xy,xz,yy,yz,zz) and trace of its inverse
+    a, b, c, e, f, i = [smooth(grad[:, p:p+1] * grad[:, q:q+1], sigma) for p, q in [(0,0),(0,1),(0,2),(1,1),(1,2),(2,2)]]
+    A = e*i - f*f; E = a*i - c*c; I = a*e - b*b
+    det = a*A + b*(c*f - b*i) + c*(b*f - c*e)
+    distinctiveness = det / (A + E + I).clamp_min(1e-8)
+    
+    mask_eroded = -F.max_pool3d(-mask.float(), d, stride=1, padding=d//2) > .5
+    maxfeat = F.max_pool3d(distinctiveness, d, stride=1, padding=d//2)
+    candidates = mask_eroded & (maxfeat == distinctiveness) & (distinctiveness > 1e-8)
+    
+    kpts = torch.nonzero(candidates[0, 0]).float()
+    if kpts.shape[0] > num_kpts:
+        _, idx = torch.topk(distinctiveness[0, 0][candidates[0, 0]], num_kpts)
+        kpts = kpts[idx]
+    return kpts.unsqueeze(0)
+
+def knn_graph(kpts, k):
+    # indices of the k nearest neighbours of every keypoint (including itself)
+    dist = pdist_squared(kpts.t().unsqueeze(0)).squeeze(0)
+    _, ind = torch.topk(dist, min(k, kpts.shape[0]), dim=1, largest=False)
+    return ind
+
+#correlation layer restricted to keypoints: SSD cost between fixed descriptors and displaced moving descriptors
+def correlate_kpts(mindssc_fix, mindssc_mov, kpts_fix, disp_mesh_t, grid_sp, shape, chunk_size=256):
+    H = int(shape[0]); W = int(shape[1]); D = int(shape[2]);
+    N = kpts_fix.shape[1]
+    disp_vox = disp_mesh_t.view(3, -1).t().float() * grid_sp
+    L = disp_vox.shape[0]
+    
+    cost = torch.zeros(N, L, device=mindssc_fix.device)
+    with torch.no_grad():
+        feat_fix = F.grid_sample(mindssc_fix.float(), kpts_pt(kpts_fix, (H, W, D)).view(1, -1, 1, 1, 3), align_corners=True).view(-1, N, 1)
+        for j1 in range(0, N, chunk_size):
+            j2 = min(j1 + chunk_size, N)
+            pos = kpts_pt(kpts_fix[0, j1:j2].unsqueeze(1) + disp_vox.unsqueeze(0), (H, W, D))
+            feat_mov = F.grid_sample(mindssc_mov.float(), pos.view(1, j2 - j1, L, 1, 3), align_corners=True).view(-1, j2 - j1, L)
+            cost[j1:j2] = (feat_fix[:, j1:j2] - feat_mov).pow(2).sum(0)
+    return cost
+
+#coupled convex optimisation on a kNN graph of keypoints instead of a dense grid
+def coupled_convex_kpts(cost, kpts_fix, disp_mesh_t, coeffs=(0.003,0.01,0.03,0.1,0.3,1), k=10):
+    disp_cand = disp_mesh_t.view(3, -1).t().float()
+    knn = knn_graph(kpts_fix[0], k)
+    
+    disp_soft = disp_cand[torch.argmin(cost, 1)][knn].mean(1)
+    
+    coeffs = torch.tensor(coeffs)
+    for j in range(len(coeffs)):
+        with torch.no_grad():
+            coupled = cost + coeffs[j] * (disp_cand.unsqueeze(0) - disp_soft.unsqueeze(1)).pow(2).sum(-1)
+            disp_soft = disp_cand[torch.argmin(coupled, 1)][knn].mean(1)
+    
+    return disp_soft
+
+
+def dice_coeff(outputs, labels, max_label):
+    dice = torch.FloatTensor(max_label-1).fill_(0)
+    for label_num in range(1, max_label):
+        iflat = (outputs==label_num).view(-1).float()
+        tflat = (labels==label_num).view(-1).float()
+        intersection = torch.mean(iflat * tflat)
+        dice[label_num-1] = (2. * intersection) / (1e-8 + torch.mean(iflat) + torch.mean(tflat))
+    return dice
+
+
+def combineDeformation3d_(disp_1st,disp_2nd,identity):
+    disp_composition = disp_2nd + F.grid_sample(disp_1st.permute(0,4,1,2,3),disp_2nd+identity).permute(0,2,3,4,1)
+    return disp_composition
+
+
+
+def find_rigid_3d(x, y):
+    x_mean = x[:, :3].mean(0)
+    y_mean = y[:, :3].mean(0)
+    u, s, v = torch.svd(torch.matmul((x[:, :3]-x_mean).t(), (y[:, :3]-y_mean)))
+    m = torch.eye(v.shape[0], v.shape[0]).to(x.device)
+    m[-1,-1] = torch.det(torch.matmul(v, u.t()))
+    rotation = torch.matmul(torch.matmul(v, m), u.t())
+    translation = y_mean - torch.matmul(rotation, x_mean)
+    T = torch.eye(4).to(x.device)
+    T[:3,:3] = rotation
+    T[:3, 3] = translation
+    return T
+def least_trimmed_rigid(fixed_pts, moving_pts, iter=5):
+    idx = torch.arange(fixed_pts.shape[0]).to(fixed_pts.device)
+    for i in range(iter):
+        x = find_rigid_3d(fixed_pts[idx,:], moving_pts[idx,:]).t()
+        residual = torch.sqrt(torch.sum(torch.pow(moving_pts - torch.mm(fixed_pts, x), 2), 1))
+        _, idx = torch.topk(residual, fixed_pts.shape[0]//2, largest=False)
+    return x.t()
+
+def least_trimmed_squares(fixed_pts,moving_pts,iter=5):
+    idx = torch.arange(fixed_pts.size(0)).to(fixed_pts.device)
+    for i in range(iter):
+        x = torch.linalg.lstsq(fixed_pts[idx,:],moving_pts[idx,:]).solution
+        residual = torch.sqrt(torch.sum(torch.pow(moving_pts - torch.mm(fixed_pts, x),2),1))
+        _,idx = torch.topk(residual,fixed_pts.size(0)//2,largest=False)
+    return x
+
+def find_transform_3d(x, y, model='rigid'):
+    # batched closed-form fit of y = T x for point sets of shape (B,N,3), model in 'rigid', 'similarity', 'affine'
+    B = x.shape[0]
+    T = torch.eye(4, device=x.device).repeat(B, 1, 1)
+    if model == 'affine':
+        x_h = torch.cat((x, torch.ones_like(x[:, :, :1])), 2)
+        T[:, :3] = torch.linalg.lstsq(x_h, y).solution.transpose(1, 2)
+        return T
+    x_mean = x.mean(1, keepdim=True)
+    y_mean = y.mean(1, keepdim=True)
+    u, s, vh = torch.linalg.svd(torch.matmul((x-x_mean).transpose(1, 2), (y-y_mean)))
+    v = vh.transpose(1, 2)
+    m = torch.eye(3, device=x.device).repeat(B, 1, 1)
+    m[:, -1, -1] = torch.det(torch.matmul(v, u.transpose(1, 2)))
+    rotation = torch.matmul(torch.matmul(v, m), u.transpose(1, 2))
+    if model == 'similarity':
+        scale = (s * m.diagonal(dim1=1, dim2=2)).sum(1) / (x-x_mean).pow(2).sum((1, 2)).clamp_min(1e-12)
+        rotation = rotation * scale.view(B, 1, 1)
+    T[:, :3, :3] = rotation
+    T[:, :3, 3] = (y_mean - torch.matmul(x_mean, rotation.transpose(1, 2))).squeeze(1)
+    return T
+
+def robust_transform_3d(fixed_pts, moving_pts, model='rigid', threshold=.05, num_hypotheses=512, num_eval=4096, iter=5):
+    # MSAC: all minimal-sample hypotheses are fitted and scored in parallel on a random subset of points,
+    # the best one is refined by least squares on its inliers
+    x = fixed_pts[:, :3].float()
+    y = moving_pts[:, :3].float()
+    N = x.shape[0]
+    m = 4 if model == 'affine' else 3
+    device = x.device
+    
+    sample = torch.randint(N, (num_hypotheses, m), device=device)
+    T = find_transform_3d(x[sample], y[sample], model)
+    idx_eval = torch.randperm(N, device=device)[:num_eval]
+    residual = (torch.matmul(x[idx_eval].unsqueeze(0), T[:, :3, :3].transpose(1, 2)) + T[:, :3, 3].unsqueeze(1) - y[idx_eval].unsqueeze(0)).pow(2).sum(2)
+    score = torch.nan_to_num(residual.clamp(max=threshold**2).sum(1), nan=float('inf'))
+    T = T[torch.argmin(score)]
+    
+    # trimmed refinement on the inliers of the best hypothesis
+    for i in range(iter):
+        residual = torch.sqrt((torch.mm(x, T[:3, :3].t()) + T[:3, 3] - y).pow(2).sum(1))
+        idx = torch.nonzero(residual < threshold).view(-1)
+        if idx.shape[0] < 2*m:
+            _, idx = torch.topk(residual, N//2, largest=False)
+        T = find_transform_3d(x[idx].unsqueeze(0), y[idx].unsqueeze(0), model)[0]
+    
+    residual = torch.sqrt((torch.mm(x, T[:3, :3].t()) + T[:3, 3] - y).pow(2).sum(1))
+    inliers = residual < threshold
+    stats = {'num_inliers': int(inliers.sum()),
+             'inlier_ratio': float(inliers.float().mean()),
+             'rmse_inliers': float(residual[inliers].pow(2).mean().sqrt()) if inliers.any() else float('nan')}
+    return T, stats
+
+
+def mind_features(img_fixed, img_moving, radius=3, dilation=3, pair=None):
+    # full resolution MIND-SSC descriptors (1,12,H,W,D) of both images in half precision
+    with torch.no_grad(), stage('mind', pair=pair):
+        mindssc_fix = MINDSSC(img_fixed.unsqueeze(0).unsqueeze(0).cuda(),radius,dilation).half()#[:,:,::2,::2,::2]#*fixed_mask.cuda().half()#.cpu()
+        mindssc_mov = MINDSSC(img_moving.unsqueeze(0).unsqueeze(0).cuda(),radius,dilation).half()#[:,:,::2,::2,::2]#*moving_mask.cuda().half()#.cpu()
+    return mindssc_fix, mindssc_mov
+
+def convex_costs(mindssc_fix, mindssc_mov, img_fixed, img_moving, grid_sp=6, disp_hw=6, sparse_grid=False, centres=None, pair=None):
+    # cost volumes of the forward and backward registration on the grid_sp grid, input of convex_optimise;
+    # centres: optional (forward, backward) displacements (1,3,H//grid_sp,W//grid_sp,D//grid_sp) in grid cells
+    # on which the search windows of the cells are centred (e.g. the previous field for a warm start)
+    H, W, D = img_fixed.shape
+    with torch.no_grad():
+        mind_fix = F.avg_pool3d(mindssc_fix,grid_sp,stride=grid_sp)
+        mind_mov = F.avg_pool3d(mindssc_mov,grid_sp,stride=grid_sp)
+        
+        mask_mov = F.avg_pool3d((img_moving>0).cuda().float().unsqueeze(0).unsqueeze(0),grid_sp,stride=grid_sp)>.5
+        mask_fix = F.avg_pool3d((img_fixed>0).cuda().float().unsqueeze(0).unsqueeze(0),grid_sp,stride=grid_sp)>.5
+        
+        disp_mesh_t = F.affine_grid(disp_hw*torch.eye(3,4).cuda().half().unsqueeze(0),(1,1,disp_hw*2+1,disp_hw*2+1,disp_hw*2+1),align_corners=True).permute(0,4,1,2,3).reshape(3,-1,1)
+        
+        costs = {'shape': (H,W,D), 'grid_sp': grid_sp, 'sparse_grid': sparse_grid, 'disp_mesh_t': disp_mesh_t, 'centres': centres}
+        centre, centre_ = centres if centres is not None else (None, None)
+        if sparse_grid:
+            with stage('correlate', pair=pair, direction='forward'):
+                costs['forward'] = correlate_sparse(mind_fix,mind_mov,mask_fix,disp_mesh_t,disp_hw,grid_sp,(H,W,D),centre=centre)
+            with stage('correlate', pair=pair, direction='backward'):
+                costs['backward'] = correlate_sparse(mind_mov,mind_fix,mask_mov,disp_mesh_t,disp_hw,grid_sp,(H,W,D),centre=centre_)
+        else:
+            with stage('correlate', pair=pair, direction='forward'):
+                if centres is None:
+                    ssd,ssd_argmin = correlate(mind_fix,mind_mov,disp_hw,grid_sp,(H,W,D))
+                else:
+                    ssd,ssd_argmin = correlate_centred(mind_fix,mind_mov,centre,disp_mesh_t,disp_hw,grid_sp,(H,W,D))
+                ssd *= mask_fix.squeeze(1)
+                costs['forward'] = (ssd,ssd_argmin)
+            with stage('correlate', pair=pair, direction='backward'):
+                if centres is None:
+                    ssd_,ssd_argmin_ = correlate(mind_mov,mind_fix,disp_hw,grid_sp,(H,W,D))
+                else:
+                    ssd_,ssd_argmin_ = correlate_centred(mind_mov,mind_fix,centre_,disp_mesh_t,disp_hw,grid_sp,(H,W,D))
+                ssd_ *= mask_mov.squeeze(1)
+                costs['backward'] = (ssd_,ssd_argmin_)
+    return costs
+
+def convex_optimise(costs, coeffs=(0.003,0.01,0.03,0.1,0.3,1), ice_iter=5, backward=False, grid=False, pair=None):
+    # coupled convex optimisation of both directions, inverse consistency and upsampling to (1,3,H,W,D) voxels;
+    # with backward=True the inverse-consistent moving->fixed field is returned as well, with grid=True also
+    # both inverse-consistent fields before upsampling (1,3,H//grid_sp,W//grid_sp,D//grid_sp) in grid cells
+    H, W, D = costs['shape']
+    grid_sp = costs['grid_sp']
+    disp_mesh_t = costs['disp_mesh_t']
+    coupled = coupled_convex_sparse if costs['sparse_grid'] else coupled_convex
+    centre, centre_ = costs['centres'] if costs['centres'] is not None else (None, None)
+    with torch.no_grad():
+        scale = torch.tensor([H//grid_sp-1,W//grid_sp-1,D//grid_sp-1]).view(1,3,1,1,1).cuda().half()/2
+        
+        with stage('coupled_convex', pair=pair, direction='forward'):
+            disp_soft = coupled(*costs['forward'],disp_mesh_t,grid_sp,(H,W,D),coeffs)
+        with stage('coupled_convex', pair=pair, direction='backward'):
+            disp_soft_ = coupled(*costs['backward'],disp_mesh_t,grid_sp,(H,W,D),coeffs)
+        if centre is not None:
+            # only the displacement relative to the window centres is regularised, the centres are added back
+            disp_soft = disp_soft+centre.to(disp_soft.dtype)
+            disp_soft_ = disp_soft_+centre_.to(disp_soft_.dtype)
+        with stage('ice', pair=pair):
+            disp_ice,disp_ice_ = inverse_consistency((disp_soft/scale).flip(1),(disp_soft_/scale).flip(1),iter=ice_iter)
+        
+        with stage('upsampling', pair=pair):
+            disp_hr = F.interpolate(disp_ice.flip(1)*scale*grid_sp,size=(H,W,D),mode='trilinear',align_corners=False)
+            if backward:
+                disp_hr_ = F.interpolate(disp_ice_.flip(1)*scale*grid_sp,size=(H,W,D),mode='trilinear',align_corners=False)
+    disp_hr = (disp_hr.float(), disp_hr_.float()) if backward else disp_hr.float()
+    if grid:
+        return disp_hr, ((disp_ice.flip(1)*scale).float(), (disp_ice_.flip(1)*scale).float())
+    return disp_hr
+
+def invert_displacement(disp_hr, iter=10):
+    # fixed point inversion inv(x) = -disp(x+inv(x)) of a (1,3,H,W,D) voxel displacement field
+    H, W, D = disp_hr.shape[2:]
+    with torch.no_grad():
+        scale = torch.tensor([H-1,W-1,D-1]).view(1,3,1,1,1).to(disp_hr)/2
+        disp = (disp_hr/scale).flip(1)
+        identity = F.affine_grid(torch.eye(3,4).unsqueeze(0).to(disp),(1,1,H,W,D),align_corners=True).permute(0,4,1,2,3)
+        disp_inv = -disp
+        for i in range(iter):
+            disp_inv = -F.grid_sample(disp,(identity+disp_inv).permute(0,2,3,4,1),align_corners=True,padding_mode='border')
+    return disp_inv.flip(1)*scale
+
+def convex_adam_kpts(mindssc_fix, mindssc_mov, img_fixed, grid_sp=6, disp_hw=6, coeffs=(0.003,0.01,0.03,0.1,0.3,1),
+                     num_kpts=4096, tps_points=2048, tps_lambda=0.1, tps_step=4, pair=None):
+    # sparse keypoint registration densified by thin plate splines, returns (1,3,H,W,D) voxels
+    H, W, D = img_fixed.shape
+    with torch.no_grad():
+        disp_mesh_t = F.affine_grid(disp_hw*torch.eye(3,4).cuda().half().unsqueeze(0),(1,1,disp_hw*2+1,disp_hw*2+1,disp_hw*2+1),align_corners=True).permute(0,4,1,2,3).reshape(3,-1,1)
+        with stage('keypoints', pair=pair):
+            kpts_fix = foerstner_kpts(img_fixed.view(1,1,H,W,D).cuda(),(img_fixed>0).view(1,1,H,W,D).cuda(),num_kpts=num_kpts)
+        with stage('correlate', pair=pair):
+            cost = correlate_kpts(mindssc_fix,mindssc_mov,kpts_fix,disp_mesh_t,grid_sp,(H,W,D))
+        with stage('coupled_convex', pair=pair):
+            disp_kpts = coupled_convex_kpts(cost,kpts_fix,disp_mesh_t,coeffs)
+        
+        del cost
+        with stage('upsampling', pair=pair):
+            disp_hr = thin_plate_dense(kpts_pt(kpts_fix,(H,W,D)),disp_kpts.unsqueeze(0)*grid_sp,(H,W,D),tps_step,tps_lambda,num_points=tps_points).permute(0,4,1,2,3)
+    return disp_hr.float()
+
+def convex_adam(img_fixed, img_moving, grid_sp=6, disp_hw=6, sparse_grid=False, use_keypoints=False,
+                num_kpts=4096, tps_points=2048, tps_lambda=0.1, tps_step=4,
+                mind_radius=3, mind_dilation=3, coeffs=(0.003,0.01,0.03,0.1,0.3,1), ice_iter=5, backward=False, pair=None):
+    # deformable registration of two (H,W,D) volumes with MIND-SSC features and coupled convex optimisation,
+    # returns the displacement field (1,3,H,W,D) in voxels from fixed to moving, and with backward=True
+    # also the field from moving to fixed (inverse-consistent, or the numerical inverse in keypoint mode)
+    mindssc_fix, mindssc_mov = mind_features(img_fixed, img_moving, mind_radius, mind_dilation, pair=pair)
+    if use_keypoints:
+        disp_hr = convex_adam_kpts(mindssc_fix, mindssc_mov, img_fixed, grid_sp, disp_hw, coeffs,
+                                   num_kpts, tps_points, tps_lambda, tps_step, pair=pair)
+        if backward:
+            with stage('invert', pair=pair):
+                return disp_hr, invert_displacement(disp_hr)
+        return disp_hr
+    costs = convex_costs(mindssc_fix, mindssc_mov, img_fixed, img_moving, grid_sp, disp_hw, sparse_grid, pair=pair)
+    del mindssc_fix, mindssc_mov
+    disp_hr = convex_optimise(costs, coeffs, ice_iter, backward, pair=pair)
+    del costs
+    torch.cuda.empty_cache()
+    return disp_hr
+
+def foreground_roi(img_fixed, img_moving, grid_sp, margin=0):
+    # bounding box of the union of fixed and moving foreground extended by margin voxels,
+    # start and size are aligned to grid_sp (clipped to the image); returns a tuple of slices
+    foreground = (img_fixed>0)|(img_moving>0)
+    roi = []
+    for dim in range(3):
+        profile = torch.nonzero(foreground.any(dim=tuple(k for k in range(3) if k != dim))).view(-1)
+        size = foreground.shape[dim]
+        if profile.shape[0] == 0:
+            roi.append(slice(0, size))
+            continue
+        start = max(0, (int(profile[0]) - margin) // grid_sp * grid_sp)
+        end = int(profile[-1]) + 1 + margin
+        end = min(size, start + -(-(end - start) // grid_sp) * grid_sp)
+        roi.append(slice(start, end))
+    return tuple(roi)
+
+def embed_roi(disp_roi, roi, shape):
+    # re-embed a displacement field (1,3,h,w,d) computed inside roi into the full grid, replicating border values
+    H, W, D = shape
+    padding = []
+    for sl, size in zip(roi[::-1], (D, W, H)):
+        padding += [sl.start, size - sl.stop]
+    if not any(padding):
+        return disp_roi
+    return F.pad(disp_roi, padding, mode='replicate')
+
+class IncrementalConvexAdam:
+    # intraoperative re-registration of successive US sweeps (fixed) to the same preoperative MR (moving):
+    # the MR descriptors and the last forward/backward fields on the grid stay resident, a new sweep is registered
+    # against the original MR with the reduced search range warm_disp_hw centred on the last fields; only the
+    # displacement relative to them is regularised and the result is an absolute field (no composition);
+    # changes of more than warm_disp_hw cells between sweeps need a cold registration, every anchor_every-th
+    # sweep is registered from scratch (0: only the first one)
+    def __init__(self, img_moving, grid_sp=6, disp_hw=6, warm_disp_hw=3, sparse_grid=False, crop_roi=True, roi_margin=12,
+                 mind_radius=3, mind_dilation=3, coeffs=(0.003,0.01,0.03,0.1,0.3,1), ice_iter=5, anchor_every=0):
+        self.img_moving = img_moving
+        self.shape = tuple(img_moving.shape)
+        self.grid_sp, self.disp_hw, self.warm_disp_hw = grid_sp, disp_hw, warm_disp_hw
+        self.sparse_grid, self.crop_roi, self.roi_margin = sparse_grid, crop_roi, roi_margin
+        self.mind_radius, self.mind_dilation = mind_radius, mind_dilation
+        self.coeffs, self.ice_iter = coeffs, ice_iter
+        self.anchor_every = anchor_every
+        with torch.no_grad(), stage('mind', direction='moving'):
+            self.mindssc_mov = MINDSSC(img_moving.unsqueeze(0).unsqueeze(0).cuda(),mind_radius,mind_dilation).half()
+        self.disp_grid = None
+        self.num_warm = 0 # warm registrations since the last cold one
+
+    def reset(self):
+        self.disp_grid = None
+        self.num_warm = 0
+
+    def register(self, img_fixed, warm_start=True, pair=None):
+        # displacement field (1,3,H,W,D) in voxels from img_fixed to the MR, warm started from the last sweep
+        H, W, D = self.shape
+        warm = warm_start and self.disp_grid is not None and not (self.anchor_every and self.num_warm+1 >= self.anchor_every)
+        # full grid of cells, the roi is aligned to grid_sp so that its cells are cells of the full grid
+        grid_shape = tuple(-(-size//self.grid_sp) for size in self.shape)
+        with torch.no_grad():
+            roi = foreground_roi(img_fixed,self.img_moving,self.grid_sp,self.roi_margin) if self.crop_roi else (slice(0,H),slice(0,W),slice(0,D))
+            roi_grid = tuple(slice(sl.start//self.grid_sp,sl.start//self.grid_sp+(sl.stop-sl.start)//self.grid_sp) for sl in roi)
+            with stage('mind', pair=pair, direction='fixed'):
+                mindssc_fix = MINDSSC(img_fixed[roi].unsqueeze(0).unsqueeze(0).cuda(),self.mind_radius,self.mind_dilation).half()
+            # search windows centred on the last forward and backward fields (kept on the grid, not resampled)
+            centres = tuple(disp[(slice(None),slice(None))+roi_grid] for disp in self.disp_grid) if warm else None
+            disp_hw = self.warm_disp_hw if warm else self.disp_hw
+            costs = convex_costs(mindssc_fix,self.mindssc_mov[(slice(None),slice(None))+roi],img_fixed[roi],self.img_moving[roi],
+                                 self.grid_sp,disp_hw,self.sparse_grid,centres,pair=pair)
+            del mindssc_fix
+            disp_hr, disp_grid = convex_optimise(costs,self.coeffs,self.ice_iter,grid=True,pair=pair)
+            del costs
+            disp_hr = embed_roi(disp_hr,roi,(H,W,D))
+            self.disp_grid = tuple(embed_roi(disp,roi_grid,grid_shape) for disp in disp_grid)
+        self.num_warm = self.num_warm+1 if warm else 0
+        return disp_hr
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Incremental intraoperative registration: successive US sweeps (fixed) are registered to the same preoperative MR
+(moving). The MR descriptors and the last displacement field stay resident (IncrementalConvexAdam); the first
+sweep is registered from scratch, every following sweep is searched with the reduced range --warm-disp-hw around
+the previous field. With --anchor-every N every N-th sweep is registered from scratch again.
+
+Example:
+    python run_incremental.py -m ../imagesTr/ReMIND2Reg_0099_0001.nii.gz \
+        -f sweep_1.nii.gz sweep_2.nii.gz sweep_3.nii.gz -o ./output/incremental
+"""
+
+import os
+import time
+import argparse
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from convex_adam_utils import *
+
+
+def _elapsed(t0):
+    torch.cuda.synchronize()
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ConvexAdam incremental re-registration of US sweeps to one MR')
+    parser.add_argument("-m", "--moving", dest="moving_path", required=True,
+                        help="preoperative MR (moving image)")
+    parser.add_argument("-f", "--fixed", dest="fixed_paths", nargs='+', required=True,
+                        help="US sweeps (fixed images on the MR grid) in acquisition order")
+    parser.add_argument("-o", "--output", dest="output_path",
+                        help="directory of the displacement fields", default="./output/incremental")
+    parser.add_argument("-g", "--grid-sp", dest="grid_sp", type=int, default=6)
+    parser.add_argument("-d", "--disp-hw", dest="disp_hw", type=int, default=6,
+                        help="search range of the first (cold) registration")
+    parser.add_argument("-w", "--warm-disp-hw", dest="warm_disp_hw", type=int, default=3,
+                        help="search range around the previous field for the following sweeps")
+    parser.add_argument("-a", "--anchor-every", dest="anchor_every", type=int, default=0,
+                        help="register every N-th sweep from scratch (0: only the first one)")
+    parser.add_argument("--cold", dest="warm_start", action='store_false', default=True,
+                        help="register every sweep from scratch (reference timings)")
+    args = parser.parse_args()
+    os.makedirs(args.output_path, exist_ok=True)
+
+    moving_nib = nib.load(args.moving_path)
+    affine_img = moving_nib.affine
+    img_moving = torch.from_numpy(moving_nib.get_fdata(dtype=np.float32))
+
+    t0 = time.perf_counter()
+    registration = IncrementalConvexAdam(img_moving, args.grid_sp, args.disp_hw, args.warm_disp_hw, roi_margin=2*args.grid_sp,
+                                         anchor_every=args.anchor_every)
+    print(f'MR descriptors: {_elapsed(t0):.2f}s')
+
+    for idx, fixed_path in enumerate(args.fixed_paths):
+        name = os.path.basename(fixed_path).replace('.nii.gz', '')
+        img_fixed = torch.from_numpy(nib.load(fixed_path).get_fdata(dtype=np.float32))
+        t0 = time.perf_counter()
+        disp_hr = registration.register(img_fixed, warm_start=args.warm_start, pair=name)
+        runtime = _elapsed(t0)
+        print(f'[{idx}] {name}: {"warm" if registration.num_warm else "cold"} {runtime:.2f}s')
+
+        disp_field_voxel = disp_hr[0].permute(1, 2, 3, 0).cpu().float().numpy()
+        nib.Nifti1Image(disp_field_voxel, affine_img).to_filename(os.path.join(args.output_path, f'disp_{name}.nii.gz'))
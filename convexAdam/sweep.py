@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Hyperparameter sweep for the ConvexAdam baseline.
+
+Every pair of the evaluation config is registered with every configuration of the parameter grid.
+Configurations are grouped so that MIND-SSC descriptors are computed once per (mind_radius, mind_dilation)
+and cost volumes once per (grid_sp, disp_hw); only the coupled convex optimisation, ICE and upsampling
+are repeated. Displacement fields are evaluated in memory with evaluate_case (no NIfTI round trip).
+
+Example:
+    python sweep.py -d .. -c ../evaluation/ground-truth/ReMIND2Reg_VAL_evaluation_config.json \
+        -g '{"grid_sp": [4, 6], "disp_hw": [4, 6], "ice_iter": [5, 10]}' -w 2 -o sweep.json
+"""
+
+import os
+import json
+import math
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+
+from convex_adam_utils import *
+from evaluation import evaluate_case, load_case_ground_truth
+from dataset import ReMIND2RegDataset
+
+
+DEFAULT_CONFIG = {'grid_sp': 6,
+                  'disp_hw': 6,
+                  'mind_radius': 3,
+                  'mind_dilation': 3,
+                  'coeffs': (0.003, 0.01, 0.03, 0.1, 0.3, 1),
+                  'ice_iter': 5}
+
+
+def expand_grid(param_grid):
+    """Cartesian product of the parameter grid on top of DEFAULT_CONFIG."""
+    for name in param_grid:
+        if name not in DEFAULT_CONFIG:
+            raise ValueError(f'Unknown sweep parameter {name}, expected one of {list(DEFAULT_CONFIG)}')
+    names = list(param_grid)
+    configs = []
+    for values in itertools.product(*[param_grid[name] for name in names]):
+        config = dict(DEFAULT_CONFIG)
+        config.update(zip(names, values))
+        config['coeffs'] = tuple(config['coeffs'])
+        configs.append(config)
+    return configs
+
+
+def _elapsed(t0):
+    torch.cuda.synchronize()
+    return time.perf_counter() - t0
+
+
+def run_job(pair, configs, data, GT_PATH, cache_paths, crop_roi=True, roi_margin=12):
+    """Register one pair with all configs sharing the same MIND parameters, return one row per config.
+    cache_paths: decoded (fixed, moving) volumes of the dataset cache."""
+    fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
+    mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
+    case = f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'
+
+    img_fixed = torch.from_numpy(np.load(cache_paths[0])).float()
+    img_moving = torch.from_numpy(np.load(cache_paths[1])).float()
+    H, W, D = img_fixed.shape
+    # aligned to every grid spacing of the job so that the cropped shape stays divisible as in run_convexadam.py
+    roi_grid = math.lcm(*[config['grid_sp'] for config in configs])
+    roi = foreground_roi(img_fixed, img_moving, roi_grid, roi_margin) if crop_roi else (slice(0, H), slice(0, W), slice(0, D))
+    gt = load_case_ground_truth(pair, data, GT_PATH)
+    img_fixed, img_moving = img_fixed[roi], img_moving[roi]
+
+    rows = []
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        mindssc_fix, mindssc_mov = mind_features(img_fixed, img_moving, configs[0]['mind_radius'], configs[0]['mind_dilation'], pair=case)
+        time_mind = _elapsed(t0)
+
+        for (grid_sp, disp_hw), group in itertools.groupby(configs, key=lambda c: (c['grid_sp'], c['disp_hw'])):
+            t0 = time.perf_counter()
+            costs = convex_costs(mindssc_fix, mindssc_mov, img_fixed, img_moving, grid_sp, disp_hw, pair=case)
+            time_costs = _elapsed(t0)
+
+            for config in group:
+                t0 = time.perf_counter()
+                disp_hr = embed_roi(convex_optimise(costs, config['coeffs'], config['ice_iter'], pair=case), roi, (H, W, D))
+                time_optimise = _elapsed(t0)
+
+                disp_field = disp_hr[0].permute(1, 2, 3, 0).cpu().numpy().astype(np.float64)
+                case_results = evaluate_case(disp_field, pair, data, GT_PATH, gt)
+                rows.append({'config': config,
+                             'case': case,
+                             'runtime': time_mind + time_costs + time_optimise,
+                             'metrics': {k: float(v['mean']) for k, v in case_results.items()}})
+            del costs
+            torch.cuda.empty_cache()
+    return rows
+
+
+def pareto_table(rows, data):
+    """Mean metrics and runtime per config; a config is Pareto optimal if no other config is at least
+    as good in TRE, SDlogJ and runtime and strictly better in one of them."""
+    tre_names = [m['name'] for m in data['evaluation_methods'] if m['metric'] == 'tre']
+    sdlogj_names = [m['name'] for m in data['evaluation_methods'] if m['metric'] == 'sdlogj']
+
+    per_config = {}
+    for row in rows:
+        key = json.dumps(row['config'])
+        per_config.setdefault(key, []).append(row)
+
+    table = []
+    for key, config_rows in per_config.items():
+        entry = {'config': config_rows[0]['config'],
+                 'num_cases': len(config_rows),
+                 'runtime': float(np.mean([r['runtime'] for r in config_rows]))}
+        for name in config_rows[0]['metrics']:
+            entry[name] = float(np.mean([r['metrics'][name] for r in config_rows]))
+        table.append(entry)
+
+    objectives = tre_names[:1] + sdlogj_names[:1] + ['runtime']
+    for entry in table:
+        values = np.array([entry[o] for o in objectives])
+        entry['pareto'] = not any(np.all(np.array([other[o] for o in objectives]) <= values) and
+                                  np.any(np.array([other[o] for o in objectives]) < values)
+                                  for other in table)
+    return sorted(table, key=lambda e: e['runtime']), objectives
+
+
+def print_table(table, objectives, swept):
+    header = swept + objectives + ['pareto']
+    print(' | '.join(f'{h: >12}' for h in header))
+    for entry in table:
+        values = [str(entry['config'][name]) for name in swept]
+        values += [f'{entry[o]:.4f}' for o in objectives]
+        values.append('*' if entry['pareto'] else '')
+        print(' | '.join(f'{v: >12}' for v in values))
+
+
+def sweep(param_grid, GT_PATH, JSON_PATH, OUTPUT_PATH, workers=1, crop_roi=True, roi_margin=12, cache_dir='./cache'):
+    with open(JSON_PATH, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    configs = expand_grid(param_grid)
+
+    # one job per pair and MIND parameters, configs sorted so that shared cost volumes are contiguous
+    jobs = {}
+    for config in configs:
+        jobs.setdefault((config['mind_radius'], config['mind_dilation']), []).append(config)
+    for mind_configs in jobs.values():
+        mind_configs.sort(key=lambda c: (c['grid_sp'], c['disp_hw']))
+    print(f'Sweep of {len(configs)} configs on {len(data["eval_pairs"])} pairs ({len(jobs)*len(data["eval_pairs"])} jobs)')
+
+    # volumes are decoded once in the background, each pair is submitted as soon as its volumes are cached
+    dataset = ReMIND2RegDataset(GT_PATH, manifest=JSON_PATH, cache_dir=cache_dir)
+    eval_paths = [{key: os.path.join(GT_PATH, pair[key]) for key in ['fixed', 'moving']} for pair in data['eval_pairs']]
+    dataset.prefetch_pairs(eval_paths)
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as executor:
+        futures = []
+        for pair, paths in zip(data['eval_pairs'], eval_paths):
+            cache_paths = (dataset.cache(paths['fixed']), dataset.cache(paths['moving']))
+            futures += [executor.submit(run_job, pair, mind_configs, data, GT_PATH, cache_paths, crop_roi, roi_margin)
+                        for mind_configs in jobs.values()]
+        for future in as_completed(futures):
+            job_rows = future.result()
+            rows += job_rows
+            print(f'{job_rows[0]["case"]}: {len(job_rows)} configs done')
+
+    dataset.close()
+
+    table, objectives = pareto_table(rows, data)
+    print_table(table, objectives, list(param_grid))
+    with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'param_grid': param_grid, 'table': table, 'cases': rows}, f, indent=4)
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ConvexAdam hyperparameter sweep')
+    parser.add_argument("-g", "--grid", dest="param_grid", required=True,
+                        help="parameter grid as JSON string or path to a JSON file, e.g. '{\"grid_sp\": [4, 6]}'")
+    parser.add_argument("-d", "--data", dest="gt_path",
+                        help="path to data (images and landmarks referenced in the config)", default="..")
+    parser.add_argument("-c", "--config", dest="config_path",
+                        help="path to config json-File", default='../evaluation/ground-truth/ReMIND2Reg_VAL_evaluation_config.json')
+    parser.add_argument("-o", "--output", dest="output_path",
+                        help="path to write the sweep results", default="sweep.json")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        help="number of worker processes", default=1)
+    parser.add_argument("--cache", dest="cache_dir",
+                        help="directory of the uncompressed volume cache", default="./cache")
+    parser.add_argument("--no-roi", dest="crop_roi", action='store_false', default=True,
+                        help="register on the full grid instead of the foreground bounding box")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.param_grid):
+        with open(args.param_grid, 'r', encoding='utf-8') as f:
+            param_grid = json.load(f)
+    else:
+        param_grid = json.loads(args.param_grid)
+    sweep(param_grid, args.gt_path, args.config_path, args.output_path, args.workers, args.crop_roi, cache_dir=args.cache_dir)
@@ -5,9 +5,8 @@ import nibabel as nib
 import numpy as np
 
 def create_zero_displacement(fixed_path, moving_path):
-    moving_nib = nib.load(moving_path)
-    moving_array = moving_nib.get_fdata()
-    D, H, W = moving_array.shape
+    # only the header is needed for the shape
+    D, H, W = nib.load(moving_path).shape[:3]
     return np.zeros((D, H, W, 3))
 
 input_dir = '/input/'
@@ -0,0 +1,128 @@
+"""
+ReMIND2Reg dataset access shared by the baselines.
+
+Volumes are decoded once from .nii.gz to an uncompressed float32 .npy cache on local disk and returned as
+read-only memory maps. prefetch() decodes upcoming volumes on a background thread pool (zlib releases
+the GIL) so that I/O overlaps with registration; header() returns affine, shape and zooms without
+reading voxel data.
+"""
+
+
+import os
+import re
+import glob
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+
+PAIR_KEYS = ['eval_pairs', 'training_paired_images', 'registration_val', 'registration_test']
+FILENAME_PATTERN = re.compile(r'ReMIND2Reg_(\d{4})_(\d{4})\.nii\.gz$')
+
+
+class ReMIND2RegDataset:
+    def __init__(self, root, manifest=None, cache_dir='./cache', num_workers=4, fixed_mod='0000'):
+        """
+        root: directory the image paths of the manifest are relative to (or containing imagesTr/ when no manifest is given)
+        manifest: Learn2Reg dataset json or evaluation config json listing {'fixed', 'moving'} pairs;
+                  if None, every ReMIND2Reg_<case>_<mod>.nii.gz of root/imagesTr is paired with <case>_<fixed_mod>
+        """
+        self.root = root
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.pairs = self._read_manifest(manifest) if manifest is not None else self._scan(fixed_mod)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._pending = {}
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _case_mod(path):
+        match = FILENAME_PATTERN.search(path)
+        if match is None:
+            raise ValueError(f'{path} does not follow the ReMIND2Reg_<case>_<mod>.nii.gz naming')
+        return match.groups()
+
+    def _pair(self, fixed, moving):
+        fix_case, fix_mod = self._case_mod(fixed)
+        mov_case, mov_mod = self._case_mod(moving)
+        return {'fixed': os.path.join(self.root, fixed), 'moving': os.path.join(self.root, moving),
+                'fixed_case': fix_case, 'fixed_mod': fix_mod, 'moving_case': mov_case, 'moving_mod': mov_mod}
+
+    def _read_manifest(self, manifest):
+        with open(manifest, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        pairs = []
+        for key in PAIR_KEYS:
+            pairs += [self._pair(p['fixed'], p['moving']) for p in data.get(key, [])]
+        return pairs
+
+    def _scan(self, fixed_mod):
+        pairs = []
+        for path in sorted(glob.glob(os.path.join(self.root, 'imagesTr', 'ReMIND2Reg_*_*.nii.gz'))):
+            match = FILENAME_PATTERN.search(path)
+            if match is None:
+                continue
+            case, mod = match.groups()
+            fixed = os.path.join('imagesTr', f'ReMIND2Reg_{case}_{fixed_mod}.nii.gz')
+            if mod != fixed_mod and os.path.isfile(os.path.join(self.root, fixed)):
+                pairs.append(self._pair(fixed, os.path.relpath(path, self.root)))
+        return pairs
+
+    def header(self, path):
+        """(affine, shape, zooms) of a volume, only the NIfTI header is read."""
+        if path not in self._headers:
+            img = nib.load(path)
+            self._headers[path] = (img.affine, img.shape, img.header.get_zooms()[:3])
+        return self._headers[path]
+
+    def _cache_path(self, path):
+        # source size and modification time invalidate stale cache entries
+        stat = os.stat(path)
+        name = os.path.basename(path).replace('.nii.gz', '').replace('.nii', '')
+        return os.path.join(self.cache_dir, f'{name}_{stat.st_size}_{stat.st_mtime_ns}.npy')
+
+    def _decode(self, path):
+        cache_path = self._cache_path(path)
+        if not os.path.isfile(cache_path):
+            array = nib.load(path).get_fdata(dtype=np.float32)
+            tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, cache_path)
+        return cache_path
+
+    def prefetch(self, paths):
+        """Decode the given volumes into the cache in the background."""
+        with self._lock:
+            for path in paths:
+                if path not in self._pending:
+                    self._pending[path] = self._executor.submit(self._decode, path)
+
+    def cache(self, path):
+        """Path of the decoded .npy file (waits for a pending prefetch of the same path), e.g. for worker processes."""
+        with self._lock:
+            future = self._pending.pop(path, None)
+        return future.result() if future is not None else self._decode(path)
+
+    def load(self, path):
+        """Voxel data as a read-only float32 memory map (waits for a pending prefetch of the same path)."""
+        return np.load(self.cache(path), mmap_mode='r')
+
+    def prefetch_pairs(self, pairs):
+        self.prefetch([p[key] for p in pairs for key in ['fixed', 'moving']])
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        """Iterate over (pair, fixed, moving) while the next pair is decoded in the background."""
+        for idx, pair in enumerate(self.pairs):
+            self.prefetch_pairs(self.pairs[idx:idx+2])
+            yield pair, self.load(pair['fixed']), self.load(pair['moving'])
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -9,10 +9,136 @@ import json
 import argparse
 import nibabel as nib
 from utils import *
+from profiling import stage
 from collections import OrderedDict
+from contextlib import ExitStack
 
 
-def evaluate_L2R(INPUT_PATH, GT_PATH, OUTPUT_PATH, JSON_PATH, verbose=False):
+def load_case_ground_truth(pair, data, GT_PATH):
+    """Spacings, landmarks, segmentations and mask used by evaluate_case for one eval_pairs entry of the config."""
+    gt = {}
+    evaluation_methods_metrics = [tmp['metric']
+                                  for tmp in data['evaluation_methods']]
+    use_mask = data.get('masked_evaluation', False)
+
+    fix_label_path = os.path.join(
+        GT_PATH, pair['fixed'].replace('images', 'labels'))
+    mov_label_path = os.path.join(
+        GT_PATH, pair['moving'].replace('images', 'labels'))
+    # with nii.gz
+
+    if any([True for eval_ in ['tre'] if eval_ in evaluation_methods_metrics]):
+        gt['spacing_fix'] = nib.load(os.path.join(
+            GT_PATH, pair['fixed'])).header.get_zooms()[:3]
+        gt['spacing_mov'] = nib.load(os.path.join(
+            GT_PATH, pair['moving'])).header.get_zooms()[:3]
+        gt['landmarks'] = {}
+        for _eval in data['evaluation_methods']:
+            if 'tre' == _eval['metric']:
+                destination = _eval['dest']
+                ## corrfield correspondences are calculated for corresponding images
+                ## therefore, if modalities are different, the keypoint paths have to be changed
+                ## if same modalities : keypointsTr / keypointsTs
+                ## if different modalities: keypoints01Tr / keypoints02Tr 
+
+                # if destination == 'keypoints' and not (fix_modality == mov_modality or (fix_modality == '0000' and mov_modality == '0001')):
+                #     modality_suffix = sorted([int(fix_modality), int(mov_modality)])
+                #     modality_suffix = str(modality_suffix[0]) + str(modality_suffix[1])
+                #     lms_fix_path = os.path.join(GT_PATH, pair['fixed'].replace(
+                #     'images', destination+modality_suffix).replace('.nii.gz', '.csv'))
+                #     lms_mov_path = os.path.join(GT_PATH, pair['moving'].replace(
+                #     'images', destination+modality_suffix).replace('.nii.gz', '.csv'))
+                # else:
+            
+                lms_fix_path = os.path.join(GT_PATH, pair['fixed'].replace(
+                    'images', destination).replace('.nii.gz', '.csv'))
+                lms_mov_path = os.path.join(GT_PATH, pair['moving'].replace(
+                    'images', destination).replace('.nii.gz', '.csv'))
+
+                gt['landmarks'][destination] = (np.loadtxt(lms_fix_path, delimiter=','),
+                                                np.loadtxt(lms_mov_path, delimiter=','))
+
+    if any([True for eval_ in ['dice', 'hd95'] if eval_ in evaluation_methods_metrics]):
+        gt['fixed_seg'] = nib.load(fix_label_path).get_fdata()
+        gt['moving_seg'] = nib.load(mov_label_path).get_fdata()
+
+    if use_mask:
+        mask_path = os.path.join(
+            GT_PATH, pair['fixed'].replace('images', 'masks'))
+        if os.path.exists(mask_path):
+            gt['mask'] = nib.load(mask_path).get_fdata()
+        else:
+            print(
+                f'Tried to use mask but did not find {mask_path}. Will evaluate without mask.')
+            gt['mask'] = None
+    return gt
+
+
+def evaluate_case(disp_field, pair, data, GT_PATH, gt=None):
+    """Metrics of one displacement field (numpy array of expected_shape) for one eval_pairs entry of the config.
+    gt: output of load_case_ground_truth, read from GT_PATH if None."""
+    case_results = {}
+    fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
+    mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
+    expected_shape = np.array(data['expected_shape'])
+    use_mask = data.get('masked_evaluation', False)
+
+    shape = np.array(disp_field.shape)
+    if not np.all(shape == expected_shape):
+        raise_shape_error(f'{fix_subject}_{fix_modality}-->{mov_subject}_{mov_modality}', shape, expected_shape) ##error here
+
+    # load neccessary files
+    if gt is None:
+        with stage('ground_truth', pair=f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'):
+            gt = load_case_ground_truth(pair, data, GT_PATH)
+
+    if 'fixed_seg' in gt:
+        fixed_seg, moving_seg = gt['fixed_seg'], gt['moving_seg']
+        D, H, W = fixed_seg.shape
+        identity = np.meshgrid(np.arange(D), np.arange(
+            H), np.arange(W), indexing='ij')
+        warped_seg = map_coordinates(
+            moving_seg, identity + disp_field.transpose(3, 0, 1, 2), order=0)
+
+    if use_mask:
+        mask = gt['mask']
+        mask_ready = mask is not None
+
+    # iterate over designated evaluation metrics
+    for _eval in data['evaluation_methods']:
+        _name = _eval['name']
+        with stage('metrics', pair=f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}', metric=_eval['metric']):
+            # mean is one value, detailed is list
+            # SDlogJ
+            if 'sdlogj' == _eval['metric']:
+                jac_det = (jacobian_determinant(disp_field[np.newaxis, :, :, :, :].transpose(
+                    (0, 4, 1, 2, 3))) + 3).clip(0.000000001, 1000000000)
+                log_jac_det = np.log(jac_det)
+                if use_mask and mask_ready:
+                    single_value = np.ma.MaskedArray(
+                        log_jac_det, 1-mask[2:-2, 2:-2, 2:-2]).std()
+                else:
+                    single_value = log_jac_det.std()
+                num_foldings = (jac_det <= 0).astype(float).sum()
+
+                case_results[_name] = {
+                    'mean': single_value, 'detailed': single_value}
+                case_results['num_foldings'] = {
+                    'mean': num_foldings, 'detailed': num_foldings}
+
+            # TRE
+            if 'tre' == _eval['metric']:
+                fix_lms, mov_lms = gt['landmarks'][_eval['dest']]
+                tre = compute_tre(fix_lms, mov_lms, disp_field,
+                                  gt['spacing_fix'], gt['spacing_mov'])
+                mean = tre.mean()
+                detailed = tre.tolist()
+                case_results[_name] = {'mean': mean, 'detailed': detailed}
+
+    return case_results
+
+
+def evaluate_L2R(INPUT_PATH, GT_PATH, OUTPUT_PATH, JSON_PATH, verbose=False, STREAM_PATH=None):
     with open(JSON_PATH, 'r', encoding='utf-8') as f:
         data = json.load(f)
 
@@ -48,131 +174,49 @@ def evaluate_L2R(INPUT_PATH, GT_PATH, OUTPUT_PATH, JSON_PATH, verbose=False):
     if use_mask and verbose:
         print("Will use masks for evaluation.")
     cases_results = {}
-    for idx, pair in enumerate(eval_pairs):
-        case_results = {}
-        fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
-        mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
-
-        fix_label_path = os.path.join(
-            GT_PATH, pair['fixed'].replace('images', 'labels'))
-        mov_label_path = os.path.join(
-            GT_PATH, pair['moving'].replace('images', 'labels'))
-        # with nii.gz
-
-        # allow short displacement file names when 
-        # a) same modalities
-        # b) modality is the same or modality is 0 and 1
-        disp_full_name = f"disp_{fix_subject}_{fix_modality}_{mov_subject}_{mov_modality}"
-
-        for file in [disp_full_name+'.npz', disp_full_name+'.nii.gz']:
-            if os.path.isfile(os.path.join(INPUT_PATH, file)):
-                disp_field = load_disp(os.path.join(INPUT_PATH, file))
-                break
-
-        shape = np.array(disp_field.shape)
-        if not np.all(shape == expected_shape):
-            raise_shape_error(f'{fix_subject}_{fix_modality}-->{mov_subject}_{mov_modality}', shape, expected_shape) ##error here
-
-        # load neccessary files
-        if any([True for eval_ in ['tre'] if eval_ in evaluation_methods_metrics]):
-            spacing_fix = nib.load(os.path.join(
-                GT_PATH, pair['fixed'])).header.get_zooms()[:3]
-            spacing_mov = nib.load(os.path.join(
-                GT_PATH, pair['moving'])).header.get_zooms()[:3]
-
-        if any([True for eval_ in ['dice', 'hd95'] if eval_ in evaluation_methods_metrics]):
-            fixed_seg = nib.load(fix_label_path).get_fdata()
-            moving_seg = nib.load(mov_label_path).get_fdata()
-            D, H, W = fixed_seg.shape
-            identity = np.meshgrid(np.arange(D), np.arange(
-                H), np.arange(W), indexing='ij')
-            warped_seg = map_coordinates(
-                moving_seg, identity + disp_field.transpose(3, 0, 1, 2), order=0)
-
-        if use_mask:
-            mask_path = os.path.join(
-                GT_PATH, pair['fixed'].replace('images', 'masks'))
-            if os.path.exists(mask_path):
-                mask = nib.load(mask_path).get_fdata()
-                mask_ready = True
-            else:
+    aggregator = MetricAggregator()
+    with ExitStack() as stack:
+        # one JSON line per finished case with the running aggregates
+        stream = stack.enter_context(open(STREAM_PATH, 'w', encoding='utf-8')) if STREAM_PATH is not None else None
+        for idx, pair in enumerate(eval_pairs):
+            fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
+            mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
+
+            # allow short displacement file names when 
+            # a) same modalities
+            # b) modality is the same or modality is 0 and 1
+            disp_full_name = f"disp_{fix_subject}_{fix_modality}_{mov_subject}_{mov_modality}"
+
+            with stage('load', pair=f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'):
+                for file in [disp_full_name+'.npz', disp_full_name+'.nii.gz']:
+                    if os.path.isfile(os.path.join(INPUT_PATH, file)):
+                        disp_field = load_disp(os.path.join(INPUT_PATH, file))
+                        break
+
+            case_results = evaluate_case(disp_field, pair, data, GT_PATH)
+            case_key = f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'
+            cases_results[case_key] = case_results
+            aggregator.update(pair, case_results)
+            if verbose:
                 print(
-                    f'Tried to use mask but did not find {mask_path}. Will evaluate without mask.')
-                mask_ready = False
-
-        # iterate over designated evaluation metrics
-        for _eval in data['evaluation_methods']:
-            _name = _eval['name']
-            # mean is one value, detailed is list
-            # SDlogJ
-            if 'sdlogj' == _eval['metric']:
-                jac_det = (jacobian_determinant(disp_field[np.newaxis, :, :, :, :].transpose(
-                    (0, 4, 1, 2, 3))) + 3).clip(0.000000001, 1000000000)
-                log_jac_det = np.log(jac_det)
-                if use_mask and mask_ready:
-                    single_value = np.ma.MaskedArray(
-                        log_jac_det, 1-mask[2:-2, 2:-2, 2:-2]).std()
-                else:
-                    single_value = log_jac_det.std()
-                num_foldings = (jac_det <= 0).astype(float).sum()
-
-                case_results[_name] = {
-                    'mean': single_value, 'detailed': single_value}
-                case_results['num_foldings'] = {
-                    'mean': num_foldings, 'detailed': num_foldings}
-
-            # TRE
-            if 'tre' == _eval['metric']:
-                destination = _eval['dest']
-                ## corrfield correspondences are calculated for corresponding images
-                ## therefore, if modalities are different, the keypoint paths have to be changed
-                ## if same modalities : keypointsTr / keypointsTs
-                ## if different modalities: keypoints01Tr / keypoints02Tr 
-
-                # if destination == 'keypoints' and not (fix_modality == mov_modality or (fix_modality == '0000' and mov_modality == '0001')):
-                #     modality_suffix = sorted([int(fix_modality), int(mov_modality)])
-                #     modality_suffix = str(modality_suffix[0]) + str(modality_suffix[1])
-                #     lms_fix_path = os.path.join(GT_PATH, pair['fixed'].replace(
-                #     'images', destination+modality_suffix).replace('.nii.gz', '.csv'))
-                #     lms_mov_path = os.path.join(GT_PATH, pair['moving'].replace(
-                #     'images', destination+modality_suffix).replace('.nii.gz', '.csv'))
-                # else:
-                
-                lms_fix_path = os.path.join(GT_PATH, pair['fixed'].replace(
-                    'images', destination).replace('.nii.gz', '.csv'))
-                lms_mov_path = os.path.join(GT_PATH, pair['moving'].replace(
-                    'images', destination).replace('.nii.gz', '.csv'))
-                    
-                fix_lms = np.loadtxt(lms_fix_path, delimiter=',')
-                mov_lms = np.loadtxt(lms_mov_path, delimiter=',')
-                tre = compute_tre(fix_lms, mov_lms, disp_field,
-                                  spacing_fix, spacing_mov)
-                mean = tre.mean()
-                detailed = tre.tolist()
-                case_results[_name] = {'mean': mean, 'detailed': detailed}
-
-        cases_results[f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'] = case_results
-        if verbose:
-            print(
-                f"case_results [{idx}] [{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}']:")
-            for k, v in case_results.items():
-                print(f"\t{k: <{20}}: {v['mean']:.5f}")
-
-    aggregated_results = {}
-    metrics = list(list(cases_results.values())[2].keys())
-    for metric in metrics:
-        for k, v in cases_results.items():
-
-            # calculate mean of all cases
-            all_means_metric = np.array(
-                [cases_results[k][metric]['mean'] for k in cases_results.keys()])
-            aggregated_results[metric] = {'mean': all_means_metric.mean(),
-                                          'std': all_means_metric.std(),
-                                          '30': np.quantile(all_means_metric, .3)}
+                    f"case_results [{idx}] [{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}']:")
+                for k, v in case_results.items():
+                    print(f"\t{k: <{20}}: {v['mean']:.5f}")
+            if stream is not None:
+                stream.write(json.dumps({'case': case_key,
+                                         'num_cases': aggregator.num_cases,
+                                         'total_cases': len_eval_pairs,
+                                         'results': case_results,
+                                         'aggregates': aggregator.aggregates(),
+                                         'groups': aggregator.group_aggregates(pair)}, default=float) + '\n')
+                stream.flush()
+
+    aggregated_results = aggregator.aggregates()
 
     with open(os.path.join(OUTPUT_PATH), 'w', encoding='utf-8') as f:
         json.dump(OrderedDict({'name': name,
                    'aggregates': aggregated_results,
+                   'groups': aggregator.group_aggregates(),
                    'cases': cases_results,
                    'eval_version': '2.0'}), f, indent=4, allow_nan=True)
 
@@ -191,8 +235,10 @@ if __name__ == "__main__":
                         help="path to write results(e.g. 'results/metrics.json')", default="metrics.json")
     parser.add_argument("-c", "--config", dest="config_path",
                         help="path to config json-File (e.g. 'evaluation_config.json')", default='ground-truth/evaluation_config.json')
+    parser.add_argument("-s", "--stream", dest="stream_path",
+                        help="optional path of a JSON lines file receiving each case and the running aggregates as soon as it is evaluated", default=None)
     parser.add_argument("-v", "--verbose", dest="verbose",
                         action='store_true', default=False)
     args = parser.parse_args()
     evaluate_L2R(args.input_path, args.gt_path, args.output_path,
-                 args.config_path, args.verbose)
+                 args.config_path, args.verbose, args.stream_path)
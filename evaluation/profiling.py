@@ -0,0 +1,141 @@
+"""
+Lightweight per-stage profiling for the ReMIND2Reg baselines and evaluation.
+
+Profiling is enabled by setting the environment variable REMIND2REG_PROFILE to an
+output prefix, e.g. REMIND2REG_PROFILE=output/profile writes
+  - output/profile.jsonl       one JSON record per stage, appended as stages finish
+  - output/profile.trace.json  Chrome trace format (chrome://tracing, Perfetto), written at exit
+Worker processes (e.g. the ProcessPoolExecutor of sweep.py) inherit the run origin through the environment and
+append to the same JSON lines file; the process that started the run builds the trace from all records of the
+run, so worker stages appear under their pid.
+When the variable is not set, stage() returns a shared no-op context manager.
+"""
+
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+PROFILE_PREFIX = os.environ.get('REMIND2REG_PROFILE', '')
+_NULL_STAGE = nullcontext()
+_lock = threading.Lock()
+_local = threading.local()
+# wall-clock origin shared by all processes of a run, set by the first one that imports this module
+_ORIGIN_VAR = 'REMIND2REG_PROFILE_ORIGIN'
+_is_run_root = _ORIGIN_VAR not in os.environ
+_t_origin = float(os.environ.setdefault(_ORIGIN_VAR, repr(time.time()))) if PROFILE_PREFIX else time.time()
+
+
+def enabled():
+    return bool(PROFILE_PREFIX)
+
+
+def _process_peak_rss_mb():
+    # peak over the whole process lifetime (ru_maxrss), not over the stage
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _cuda():
+    # only look at the allocator if the caller already uses torch with a GPU
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def _gpu_stack():
+    if not hasattr(_local, 'gpu_peaks'):
+        _local.gpu_peaks = []
+    return _local.gpu_peaks
+
+
+@contextmanager
+def _profiled_stage(name, args):
+    cuda = _cuda()
+    if cuda is not None:
+        cuda.synchronize()
+        # the allocator peak is reset for this stage, keep what the enclosing stage reached so far
+        peaks = _gpu_stack()
+        if peaks:
+            peaks[-1] = max(peaks[-1], cuda.max_memory_allocated())
+        cuda.reset_peak_memory_stats()
+        peaks.append(0)
+    start = time.time()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield
+    finally:
+        if cuda is not None:
+            cuda.synchronize()
+            peak_gpu = max(peaks.pop(), cuda.max_memory_allocated())
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak_gpu)
+        wall1 = time.perf_counter()
+        event = {'stage': name,
+                 'run': _t_origin,
+                 'start': start - _t_origin,
+                 'wall_time': wall1 - wall0,
+                 'cpu_time': time.process_time() - cpu0,
+                 'process_peak_rss_mb': _process_peak_rss_mb(),
+                 'pid': os.getpid(),
+                 'tid': threading.get_ident()}
+        if cuda is not None:
+            event['peak_gpu_mb'] = peak_gpu / 2**20
+        event.update(args)
+        with _lock:
+            with open(PROFILE_PREFIX + '.jsonl', 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event) + '\n')
+
+
+def stage(name, **args):
+    """Context manager timing one pipeline stage; extra keyword arguments (e.g. pair) are recorded."""
+    if not PROFILE_PREFIX:
+        return _NULL_STAGE
+    return _profiled_stage(name, args)
+
+
+def load_events(run=None):
+    """Records of the JSON lines file, by default only those of the current run (all processes)."""
+    run = _t_origin if run is None else run
+    if not os.path.isfile(PROFILE_PREFIX + '.jsonl'):
+        return []
+    with _lock, open(PROFILE_PREFIX + '.jsonl', 'r', encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return [event for event in events if event.get('run') == run]
+
+
+def export_chrome_trace(path=None, events=None):
+    if path is None:
+        path = PROFILE_PREFIX + '.trace.json'
+    if events is None:
+        events = load_events()
+    trace = []
+    for event in events:
+        args = {k: v for k, v in event.items() if k not in ['stage', 'run', 'start', 'wall_time', 'pid', 'tid']}
+        trace.append({'name': event['stage'], 'ph': 'X', 'cat': 'remind2reg',
+                      'ts': event['start'] * 1e6, 'dur': event['wall_time'] * 1e6,
+                      'pid': event['pid'], 'tid': event['tid'], 'args': args})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+if PROFILE_PREFIX:
+    os.makedirs(os.path.dirname(os.path.abspath(PROFILE_PREFIX)), exist_ok=True)
+    if _is_run_root:
+        # atexit does not run in multiprocessing workers, their stages are read back from the JSON lines file
+        atexit.register(lambda: load_events() and export_chrome_trace())
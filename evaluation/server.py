@@ -0,0 +1,200 @@
+"""
+Local evaluation server for the ReMIND2Reg challenge.
+
+Ground truth (spacings, landmarks, masks) of every pair of the evaluation config is loaded once at start-up
+and kept in memory; displacement fields are evaluated with evaluate_case on a thread pool.
+
+Start (HTTP on localhost, or a Unix socket with -s):
+    python server.py -d ground-truth -c ground-truth/ReMIND2Reg_VAL_evaluation_config.json -p 8765 -w 4
+
+Endpoints (responses follow the metrics.json schema of evaluate_L2R):
+    GET  /health                          {"status": "ok", "cases": [...]}
+    POST /evaluate/<disp_name>            body: displacement field as .npz or .nii.gz bytes (e.g. np.savez),
+                                          or JSON {"path": "<file.npz|file.nii.gz>"}
+    POST /evaluate                        body: JSON {"input": "<directory of disp_*.npz|nii.gz>"}
+where <disp_name> is the file name stem expected by evaluate_L2R, e.g. disp_0099_0000_0099_0001.
+
+    curl --data-binary @disp_0099_0000_0099_0001.npz localhost:8765/evaluate/disp_0099_0000_0099_0001
+"""
+
+
+import io
+import os
+import json
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.request import Request, urlopen
+
+from utils import *
+from evaluation import evaluate_case, load_case_ground_truth
+from profiling import stage
+
+
+def disp_name(pair):
+    fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
+    mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
+    return f"disp_{fix_subject}_{fix_modality}_{mov_subject}_{mov_modality}"
+
+
+def case_key(pair):
+    fix_subject, fix_modality = pair['fixed'][-16:-12], pair['fixed'][-11:-7]
+    mov_subject, mov_modality = pair['moving'][-16:-12], pair['moving'][-11:-7]
+    return f'{fix_subject}_{fix_modality}<--{mov_subject}_{mov_modality}'
+
+
+class Evaluator:
+    def __init__(self, GT_PATH, JSON_PATH, workers=4):
+        with open(JSON_PATH, 'r', encoding='utf-8') as f:
+            self.data = json.load(f)
+        self.GT_PATH = GT_PATH
+        self.pairs = OrderedDict((disp_name(pair), pair) for pair in self.data['eval_pairs'])
+        self.gt = {}
+        for name, pair in self.pairs.items():
+            with stage('ground_truth', pair=case_key(pair)):
+                self.gt[name] = load_case_ground_truth(pair, self.data, GT_PATH)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _evaluate(self, name, disp_field):
+        if name not in self.pairs:
+            raise ValidationError(f"Unknown displacement field {name}, expected one of {list(self.pairs)}.")
+        pair = self.pairs[name]
+        if isinstance(disp_field, str):
+            with stage('load', pair=case_key(pair)):
+                disp_field = load_disp(disp_field)
+        return evaluate_case(disp_field, pair, self.data, self.GT_PATH, self.gt[name])
+
+    def evaluate(self, disp_fields):
+        """disp_fields: {disp_name: array or path}; returns the metrics.json schema restricted to these pairs."""
+        futures = OrderedDict((name, self.executor.submit(self._evaluate, name, disp_field))
+                              for name, disp_field in disp_fields.items())
+        cases_results = OrderedDict()
+        aggregator = MetricAggregator()
+        for name, future in futures.items():
+            case_results = future.result()
+            cases_results[case_key(self.pairs[name])] = case_results
+            aggregator.update(self.pairs[name], case_results)
+        return OrderedDict({'name': self.data['task_name'],
+                            'aggregates': aggregator.aggregates(),
+                            'groups': aggregator.group_aggregates(),
+                            'cases': cases_results,
+                            'eval_version': '2.0'})
+
+    def evaluate_directory(self, INPUT_PATH):
+        disp_fields = OrderedDict()
+        for name in self.pairs:
+            for file in [name+'.npz', name+'.nii.gz']:
+                if os.path.isfile(os.path.join(INPUT_PATH, file)):
+                    disp_fields[name] = os.path.join(INPUT_PATH, file)
+                    break
+            else:
+                raise_missing_file_error(name+'[.nii.gz/.npz]')
+        return self.evaluate(disp_fields)
+
+
+def read_array(body):
+    """Displacement field from the bytes of a .nii.gz or .npz file, read with load_disp as in evaluate_L2R."""
+    if body[:2] == b'\x1f\x8b':
+        fname = 'body.nii.gz'
+    elif body[:2] == b'PK':
+        fname = 'body.npz'
+    else:
+        raise ValidationError("The displacement field should be either a .nii.gz or a .npz file.")
+    return load_disp(fname, io.BytesIO(body))
+
+
+class EvaluationHandler(BaseHTTPRequestHandler):
+    evaluator = None
+
+    def _send(self, code, content):
+        body = json.dumps(content, default=float, allow_nan=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is an empty string for Unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self._send(200, {'status': 'ok', 'cases': list(self.evaluator.pairs)})
+        else:
+            self._send(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        parts = [p for p in self.path.split('/') if p]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if parts == ['evaluate']:
+                request = json.loads(body)
+                self._send(200, self.evaluator.evaluate_directory(request['input']))
+            elif len(parts) == 2 and parts[0] == 'evaluate':
+                if self.headers.get_content_type() == 'application/json':
+                    disp_field = json.loads(body)['path']
+                else:
+                    disp_field = read_array(body)
+                self._send(200, self.evaluator.evaluate({parts[1]: disp_field}))
+            else:
+                self._send(404, {'error': f'Unknown path {self.path}'})
+        except (ValidationError, ValueError, KeyError, OSError) as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': f'{type(e).__name__}: {e}'})
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ''
+
+
+def request_evaluation(url, name, disp_field):
+    """Client helper: evaluate one displacement field (numpy array) on a running HTTP server."""
+    buffer = io.BytesIO()
+    np.savez(buffer, disp_field)
+    request = Request(f"{url.rstrip('/')}/evaluate/{name}", data=buffer.getvalue(),
+                      headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(request) as response:
+        return json.load(response)
+
+
+def serve(GT_PATH, JSON_PATH, port=8765, socket_path=None, workers=4):
+    EvaluationHandler.evaluator = Evaluator(GT_PATH, JSON_PATH, workers)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, EvaluationHandler)
+        print(f'Serving {len(EvaluationHandler.evaluator.pairs)} cases on unix socket {socket_path}')
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), EvaluationHandler)
+        print(f'Serving {len(EvaluationHandler.evaluator.pairs)} cases on http://127.0.0.1:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        EvaluationHandler.evaluator.executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='L2R evaluation server keeping the ground truth in memory')
+    parser.add_argument("-d", "--data", dest="gt_path",
+                        help="path to data", default="ground-truth")
+    parser.add_argument("-c", "--config", dest="config_path",
+                        help="path to config json-File (e.g. 'evaluation_config.json')", default='ground-truth/evaluation_config.json')
+    parser.add_argument("-p", "--port", dest="port", type=int,
+                        help="port on 127.0.0.1", default=8765)
+    parser.add_argument("-s", "--socket", dest="socket_path",
+                        help="serve on this unix socket instead of a TCP port", default=None)
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        help="number of cases evaluated concurrently", default=4)
+    args = parser.parse_args()
+    serve(args.gt_path, args.config_path, args.port, args.socket_path, args.workers)
@@ -1,3 +1,6 @@
+import gzip
+import math
+import heapq
 import numpy as np
 import scipy.ndimage
 import nibabel as nib
@@ -47,6 +50,108 @@ def compute_tre(fix_lms, mov_lms, disp, spacing_fix, spacing_mov):
     return np.linalg.norm((fix_lms_warped - mov_lms) * spacing_mov, axis=1)
 
 
+##### aggregation #####
+MODALITY_NAMES = {'0000': 'US', '0001': 'T1', '0002': 'T2'}
+
+
+class RunningStats:
+    """
+    Mean/std (Welford) and the q-quantile (linear interpolation as np.quantile) of a stream of per-case values.
+    The two order statistics around the quantile are kept at the tops of two heaps (values below and above),
+    so an update is O(log n) and a summary O(1); streaming n cases costs O(n log n) with O(n) memory.
+    """
+    def __init__(self, q=.3):
+        self.q = q
+        self.count = 0
+        self.num_nan = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self._lower = []  # max-heap (negated) of the floor(q*(count-1))+1 smallest values
+        self._upper = []  # min-heap of the others
+
+    def update(self, value):
+        value = float(value)
+        if math.isnan(value):
+            self.num_nan += 1
+            return
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+        if self._lower and value <= -self._lower[0]:
+            heapq.heappush(self._lower, -value)
+        else:
+            heapq.heappush(self._upper, value)
+        size = math.floor((self.count - 1) * self.q) + 1
+        while len(self._lower) > size:
+            heapq.heappush(self._upper, -heapq.heappop(self._lower))
+        while len(self._lower) < size:
+            heapq.heappush(self._lower, -heapq.heappop(self._upper))
+
+    def quantile(self):
+        index = (self.count - 1) * self.q
+        t = index - math.floor(index)
+        a = -self._lower[0]
+        b = self._upper[0] if self._upper else a
+        # same lerp as np.quantile
+        return b - (b - a) * (1 - t) if t >= .5 else a + (b - a) * t
+
+    def summary(self):
+        # NaN propagates as in np.mean/np.std/np.quantile
+        if self.num_nan or not self.count:
+            return {'mean': float('nan'), 'std': float('nan'), '30': float('nan')}
+        return {'mean': self._mean,
+                'std': math.sqrt(self._m2 / self.count),
+                '30': self.quantile()}
+
+
+class MetricAggregator:
+    """
+    Aggregates the per-case 'mean' of every metric as cases finish, overall and per group:
+    moving_modality (T1/T2) and subject. An update is O(log n) in the number of cases n and a summary of a
+    metric O(1), so streaming the running aggregates after every case costs O(n log n) overall.
+    """
+    def __init__(self, group_by=('moving_modality', 'subject')):
+        self.group_by = group_by
+        self.metrics = []
+        self.num_cases = 0
+        self._overall = {}
+        self._groups = {key: {} for key in group_by}
+        self._group_counts = {key: {} for key in group_by}
+
+    @staticmethod
+    def case_groups(pair):
+        fix_subject = pair['fixed'][-16:-12]
+        mov_modality = pair['moving'][-11:-7]
+        return {'moving_modality': MODALITY_NAMES.get(mov_modality, mov_modality),
+                'subject': fix_subject}
+
+    def update(self, pair, case_results):
+        self.num_cases += 1
+        groups = self.case_groups(pair)
+        for key in self.group_by:
+            self._group_counts[key][groups[key]] = self._group_counts[key].get(groups[key], 0) + 1
+        for metric, result in case_results.items():
+            if metric not in self.metrics:
+                self.metrics.append(metric)
+            self._overall.setdefault(metric, RunningStats()).update(result['mean'])
+            for key in self.group_by:
+                group = self._groups[key].setdefault(groups[key], {})
+                group.setdefault(metric, RunningStats()).update(result['mean'])
+
+    def aggregates(self):
+        return {metric: self._overall[metric].summary() for metric in self.metrics}
+
+    def group_aggregates(self, pair=None):
+        """Summaries of all groups, or only of the groups of pair (keeps streamed records O(1) in size)."""
+        selected = self.case_groups(pair) if pair is not None else None
+        return {key: {value: dict({'num_cases': self._group_counts[key][value]},
+                                  **{metric: stats[metric].summary() for metric in self.metrics if metric in stats})
+                      for value, stats in groups.items() if selected is None or value == selected[key]}
+                for key, groups in self._groups.items()}
+
+
 ##### validation errors #####
 def raise_missing_file_error(fname):
     message = (
@@ -71,14 +176,19 @@ def raise_shape_error(fname, shape, expected_shape):
 
 
 ##### load displacement field #####
-def load_disp(fname):
+def load_disp(fname, fileobj=None):
     ##if .nii.gz use nibabel
     ##if .npy use numpy
     ##else raise error
+    ##fileobj: content of fname already in memory (e.g. a request body of the server), fname only gives the format
     if fname.endswith('.nii.gz'):
-        disp = nib.load(fname).get_fdata()
+        if fileobj is not None:
+            disp = nib.Nifti1Image.from_bytes(gzip.decompress(fileobj.read())).get_fdata()
+        else:
+            disp = nib.load(fname).get_fdata()
     elif fname.endswith('.npz'):
-        disp = np.load(fname, allow_pickle=True)['arr_0']
+        # no pickled objects from in-memory (untrusted) archives
+        disp = np.load(fname if fileobj is None else fileobj, allow_pickle=fileobj is None)['arr_0']
         if disp.dtype != np.float64:
             disp = disp.astype(np.float64)
     else:
@@ -0,0 +1,228 @@
+"""
+In-process affine block-matching registration following reg_aladin (Ourselin et al. 2001, Modat et al. 2014).
+
+A pyramid of the fixed (reference) and moving (floating) images is built; at every level the fixed image is
+divided into 4x4x4 blocks, the blocks of highest variance inside the fixed mask are matched with an
+exhaustive search in the warped moving image (NCC of intensities or SSD of MIND descriptors), and the
+transformation is updated from the correspondences by trimmed least squares.
+Everything stays in memory: images, masks and the resulting matrix.
+"""
+
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, map_coordinates, uniform_filter
+
+
+BLOCK_SIZE = 4
+
+
+def foreground_box(fixed, moving, margin=10):
+    """Slices of the bounding box of the union of both foregrounds (same grid), extended by margin voxels."""
+    foreground = (fixed > 0) | (moving > 0)
+    if not foreground.any():
+        return tuple(slice(0, s) for s in fixed.shape)
+    box = []
+    for axis in range(3):
+        profile = np.nonzero(foreground.any(axis=tuple(k for k in range(3) if k != axis)))[0]
+        box.append(slice(max(0, int(profile[0]) - margin), min(fixed.shape[axis], int(profile[-1]) + 1 + margin)))
+    return tuple(box)
+
+
+def crop_affine(affine, box):
+    """Voxel-to-world matrix of the cropped image."""
+    shift = np.eye(4)
+    shift[:3, 3] = [s.start for s in box]
+    return affine @ shift
+
+
+def mind(img, radius=1, dilation=2):
+    """MIND descriptors with a six-neighbourhood (Heinrich et al. 2012), shape (6, H, W, D)."""
+    pad = np.pad(img, dilation, mode='edge')
+    H, W, D = img.shape
+    dist = []
+    for axis in range(3):
+        for sign in [-1, 1]:
+            start = [dilation] * 3
+            start[axis] += sign * dilation
+            shifted = pad[start[0]:start[0]+H, start[1]:start[1]+W, start[2]:start[2]+D]
+            dist.append(uniform_filter((img - shifted) ** 2, 2 * radius + 1))
+    dist = np.stack(dist)
+    dist -= dist.min(0)
+    var = dist.mean(0)
+    var = np.clip(var, var.mean() * 0.001, var.mean() * 1000)
+    desc = np.exp(-dist / var)
+    return (desc / desc.max(0)).astype(np.float32)
+
+
+def fit_transform(fixed_pts, moving_pts, model='affine'):
+    """Least-squares 4x4 matrix mapping fixed_pts (N,3) to moving_pts (N,3), 'rigid' (Kabsch) or 'affine'."""
+    if model == 'rigid':
+        fixed_mean, moving_mean = fixed_pts.mean(0), moving_pts.mean(0)
+        u, _, vt = np.linalg.svd((fixed_pts - fixed_mean).T @ (moving_pts - moving_mean))
+        sign = np.sign(np.linalg.det(vt.T @ u.T))
+        rotation = vt.T @ np.diag([1, 1, sign]) @ u.T
+        translation = moving_mean - rotation @ fixed_mean
+    else:
+        x = np.linalg.lstsq(np.c_[fixed_pts, np.ones(len(fixed_pts))], moving_pts, rcond=None)[0]
+        rotation, translation = x[:3].T, x[3]
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = translation
+    return transform
+
+
+def trimmed_least_squares(fixed_pts, moving_pts, model='affine', inlier_percent=50, iter=10):
+    """Fit, keep the inlier_percent correspondences of lowest residual and refit until the inlier set is stable."""
+    num_inliers = max(4, int(len(fixed_pts) * inlier_percent / 100))
+    inliers = np.arange(len(fixed_pts))
+    for _ in range(iter):
+        transform = fit_transform(fixed_pts[inliers], moving_pts[inliers], model)
+        residuals = np.linalg.norm(fixed_pts @ transform[:3, :3].T + transform[:3, 3] - moving_pts, axis=1)
+        new_inliers = np.sort(np.argsort(residuals)[:num_inliers])
+        if len(new_inliers) == len(inliers) and np.all(new_inliers == inliers):
+            break
+        inliers = new_inliers
+    return transform
+
+
+def _block_positions(fixed, fixed_mask, block_percent):
+    """Start indices (N,3) of the blocks fully inside the mask with the highest variance."""
+    shape = np.array(fixed.shape) // BLOCK_SIZE
+    crop = tuple(slice(0, s * BLOCK_SIZE) for s in shape)
+    blocks = fixed[crop].reshape(shape[0], BLOCK_SIZE, shape[1], BLOCK_SIZE, shape[2], BLOCK_SIZE)
+    blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(-1, BLOCK_SIZE ** 3)
+    inside = fixed_mask[crop].reshape(shape[0], BLOCK_SIZE, shape[1], BLOCK_SIZE, shape[2], BLOCK_SIZE).all(axis=(1, 3, 5)).reshape(-1)
+    variance = np.where(inside, blocks.var(1), -1)
+    num_blocks = int(inside.sum() * block_percent / 100)
+    selected = np.argsort(-variance)[:num_blocks]
+    selected = selected[variance[selected] > 0]
+    return np.stack(np.unravel_index(selected, shape), 1) * BLOCK_SIZE
+
+
+def _patches(volume, starts, size):
+    """Cubes of the given size starting at starts (N,3) of a (C,H,W,D) volume, shape (N,C,size,size,size)."""
+    ar = np.arange(size)
+    x = starts[:, 0, None, None, None] + ar[:, None, None]
+    y = starts[:, 1, None, None, None] + ar[None, :, None]
+    z = starts[:, 2, None, None, None] + ar[None, None, :]
+    return volume[:, x, y, z].transpose(1, 0, 2, 3, 4)
+
+
+def _warped_patches(volume, mask, matrix, starts, search):
+    """Search windows of the moving volume (C,H,W,D) and mask resampled at the fixed voxels around every block,
+    matrix maps fixed to moving voxel coordinates. Only these windows are resampled, not the whole image."""
+    window = BLOCK_SIZE + 2 * search
+    ar = np.arange(window) - search
+    grid = np.stack(np.meshgrid(ar, ar, ar, indexing='ij'), 0).reshape(3, -1)
+    points = (starts.T[:, :, None] + grid[:, None, :]).reshape(3, -1)
+    points = matrix[:3, :3] @ points + matrix[:3, 3:]
+    shape = (len(starts), window, window, window)
+    patches = np.stack([map_coordinates(v, points, order=1, mode='constant', cval=0).reshape(shape) for v in volume], 1)
+    patch_mask = map_coordinates(mask.astype(np.float32), points, order=0, mode='constant', cval=0).reshape(shape)
+    return patches, patch_mask > 0
+
+
+def block_matching(block_fix, patches, patch_mask, search=4, similarity='lncc', chunk_size=128):
+    """Best displacement (N,3) in [-search, search]^3 of every block and a validity flag (N,).
+    block_fix: (N,C,4,4,4) fixed blocks; patches, patch_mask: (N,C,w,w,w) and (N,w,w,w) moving search windows,
+    w = 4 + 2*search. C=1 for intensities (NCC), C>1 for descriptors (SSD)."""
+    N, C = block_fix.shape[:2]
+    n = BLOCK_SIZE ** 3
+    block_fix = block_fix.reshape(N, C * n)
+    offsets = np.stack(np.meshgrid(*[np.arange(-search, search + 1)] * 3, indexing='ij'), -1).reshape(-1, 3)
+
+    displacements = np.zeros((N, 3), dtype=int)
+    valid = np.zeros(N, dtype=bool)
+    step = max(1, chunk_size // C)
+    for i in range(0, N, step):
+        idx = slice(i, i + step)
+        fix = block_fix[idx]
+        # (B, C, 9, 9, 9, 4, 4, 4) -> (B, 729, C*64)
+        windows = np.lib.stride_tricks.sliding_window_view(patches[idx], (BLOCK_SIZE,) * 3, axis=(2, 3, 4))
+        windows = windows.transpose(0, 2, 3, 4, 1, 5, 6, 7).reshape(len(fix), -1, C * n)
+        inside = np.lib.stride_tricks.sliding_window_view(patch_mask[idx], (BLOCK_SIZE,) * 3, axis=(1, 2, 3))
+        inside = inside.reshape(len(fix), -1, n).all(-1)
+
+        cross = np.einsum('bkc,bc->bk', windows, fix)
+        if similarity == 'lncc':
+            mean_mov = windows.mean(-1)
+            std_mov = np.sqrt(np.maximum((windows ** 2).mean(-1) - mean_mov ** 2, 0))
+            mean_fix = fix.mean(-1, keepdims=True)
+            std_fix = fix.std(-1, keepdims=True)
+            score = (cross / n - mean_fix * mean_mov) / (std_fix * std_mov + 1e-8)
+            inside &= std_mov > 1e-6
+        else:
+            # negative SSD of the descriptors
+            score = 2 * cross - (windows ** 2).sum(-1) - (fix ** 2).sum(-1, keepdims=True)
+        score = np.where(inside, score, -np.inf)
+        best = score.argmax(1)
+        displacements[idx] = offsets[best]
+        valid[idx] = np.isfinite(score[np.arange(len(best)), best])
+    return displacements, valid
+
+
+def _pyramid(img, mask, affine, factor):
+    if factor == 1:
+        return img, mask, affine
+    img = gaussian_filter(img, factor / 2)[::factor, ::factor, ::factor]
+    mask = mask[::factor, ::factor, ::factor]
+    return img, mask, affine @ np.diag([factor, factor, factor, 1])
+
+
+def aladin(fixed, moving, affine_fixed, affine_moving, fixed_mask=None, moving_mask=None, init=None,
+           ln=3, lp=None, maxit=5, rig_only=False, aff_direct=False, block_percent=50, inlier_percent=50,
+           similarity='lncc', search=4, verbose=False):
+    """
+    Affine registration of moving (floating) to fixed (reference) in the spirit of
+    reg_aladin -ln <ln> -lp <lp> -maxit <maxit> -%v <block_percent> -%i <inlier_percent> [-rigOnly] [-affDirect] -noSym.
+
+    fixed, moving: 3D arrays; affine_fixed, affine_moving: voxel-to-world (RAS) matrices;
+    fixed_mask, moving_mask: boolean arrays (default: intensity > 0); init: initial 4x4 matrix (default identity, as -nac).
+    similarity: 'lncc' (normalised cross correlation of the blocks) or 'mind' (SSD of MIND descriptors);
+    search: half width in voxels of the block search at every level.
+    Returns the 4x4 world matrix mapping fixed to moving points, i.e. the matrix written by reg_aladin -aff.
+    """
+    fixed = np.asarray(fixed, dtype=np.float32)
+    moving = np.asarray(moving, dtype=np.float32)
+    fixed_mask = fixed > 0 if fixed_mask is None else np.asarray(fixed_mask, dtype=bool)
+    moving_mask = moving > 0 if moving_mask is None else np.asarray(moving_mask, dtype=bool)
+    transform = np.eye(4) if init is None else np.array(init, dtype=float)
+    lp = ln if lp is None else min(lp, ln)
+
+    for level in range(lp):
+        factor = 2 ** (ln - 1 - level)
+        fix, fix_mask, aff_fix = _pyramid(fixed, fixed_mask, affine_fixed, factor)
+        mov, mov_mask, aff_mov = _pyramid(moving, moving_mask, affine_moving, factor)
+        if similarity == 'mind':
+            fix_feat, mov_feat = mind(fix), mind(mov)
+        else:
+            fix_feat, mov_feat = fix[None], mov[None]
+        starts = _block_positions(fix, fix_mask, block_percent)
+        block_fix = _patches(fix_feat, starts, BLOCK_SIZE)
+        centers_world = (np.c_[starts + (BLOCK_SIZE - 1) / 2, np.ones(len(starts))] @ aff_fix.T)[:, :3]
+
+        if rig_only:
+            models = ['rigid']
+        elif aff_direct or level > 0:
+            models = ['affine']
+        else:
+            models = ['rigid', 'affine']
+        for model in models:
+            for it in range(maxit):
+                # fixed voxel -> fixed world -> moving world -> moving voxel
+                matrix = np.linalg.inv(aff_mov) @ transform @ aff_fix
+                patches, patch_mask = _warped_patches(mov_feat, mov_mask, matrix, starts, search)
+                displacements, valid = block_matching(block_fix, patches, patch_mask, search, similarity)
+                if valid.sum() < 4:
+                    break
+                # the displaced block centre q samples the moving image at transform @ aff_fix @ q
+                matched = np.c_[starts[valid] + (BLOCK_SIZE - 1) / 2 + displacements[valid], np.ones(valid.sum())]
+                matched_world = (matched @ (transform @ aff_fix).T)[:, :3]
+                new_transform = trimmed_least_squares(centers_world[valid], matched_world, model, inlier_percent)
+                change = np.abs(new_transform - transform).max()
+                transform = new_transform
+                if verbose:
+                    print(f'level {level+1}/{lp} {model} it {it+1}: {valid.sum()} blocks, change {change:.4f}')
+                if change < 1e-3:
+                    break
+    return transform
@@ -1,9 +1,16 @@
 import os
+import sys
+import tempfile
 import numpy as np
 import SimpleITK as sitk
 from scipy.ndimage import map_coordinates
 import nibabel as nib
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evaluation'))
+from profiling import stage
+from dataset import ReMIND2RegDataset
+from aladin import aladin, foreground_box, crop_affine
+
 FLIPXY_44 = np.diag([-1, -1, 1, 1])
 
 def clean_cmdline(cmd):
@@ -24,6 +31,16 @@ def _matrix_to_itk_transform(matrix, dimensions=3):
     return transform
 
 
+def image_from_array(array, affine):
+    """SimpleITK image of an array already loaded with nibabel (RAS affine), same geometry as sitk.ReadImage."""
+    lps = np.dot(FLIPXY_44, affine)
+    spacing = np.linalg.norm(lps[:3, :3], axis=0)
+    img = sitk.GetImageFromArray(np.asarray(array).transpose(2, 1, 0)) # Convention sitk
+    img.SetSpacing(spacing.tolist())
+    img.SetDirection((lps[:3, :3] / spacing).ravel().tolist())
+    img.SetOrigin(lps[:3, 3].tolist())
+    return img
+
 def create_displacement_field(matrix, mov_img):
     """The nitfy file contains the matrix from floating to reference."""
     transform = _matrix_to_itk_transform(matrix)
@@ -49,6 +66,20 @@ def get_mask(ref):
     output =  sitk.Cast(output, sitk.sitkFloat32)
     return output 
 
+def crop_foreground(fixed_img, moving_img, margin=10):
+    """Crop both images (same grid) to the bounding box of the union of their foregrounds, keeping the physical space."""
+    foreground = (sitk.GetArrayFromImage(fixed_img)>0) | (sitk.GetArrayFromImage(moving_img)>0)
+    if not foreground.any():
+        return fixed_img, moving_img
+    index, size = [], []
+    for axis in [2, 1, 0]: # numpy (z,y,x) to sitk (x,y,z)
+        profile = np.nonzero(foreground.any(axis=tuple(k for k in range(3) if k != axis)))[0]
+        start = max(0, int(profile[0]) - margin)
+        end = min(foreground.shape[axis], int(profile[-1]) + 1 + margin)
+        index.append(start)
+        size.append(end - start)
+    return sitk.RegionOfInterest(fixed_img, size, index), sitk.RegionOfInterest(moving_img, size, index)
+
 validation_cases = ['0098', '0099', '0100', '0101', '0102']
 reg_directions = [
     {'moving':'0001', 'fixed':'0000'},
@@ -56,70 +87,117 @@ reg_directions = [
                 ]
 path_data = '/Users/reubendo/Documents/repo/Learn2RegChallenge/ReMIND2Reg/imagesTr'
 path_output = './output'
+path_cache = './cache' # uncompressed float32 copies of the volumes for repeated runs
+crop_roi = True # register inside the bounding box of the fixed/moving foreground only
+roi_margin = 10 # voxels
+use_reg_aladin = False # True: external NiftyReg binary, False: in-process block matching (aladin.py)
+aladin_levels = {'ln': 2, 'lp': 10} # same level controls as reg_aladin -ln 2 -lp 10
+similarity = 'lncc' # 'lncc' or 'mind' (in-process only)
 for dir in ['niftyreg', 'mask', 'disp']:
     os.makedirs(os.path.join(path_output, dir), exist_ok=True)
 
 from nibabel.affines import apply_affine
 
+dataset = ReMIND2RegDataset(os.path.dirname(path_data), cache_dir=path_cache)
+dataset.prefetch([os.path.join(path_data, f"ReMIND2Reg_{case}_{reg_direction[key]}.nii.gz")
+                  for case in validation_cases for reg_direction in reg_directions for key in ['fixed', 'moving']])
+
 for case in validation_cases:
     for reg_direction in reg_directions:
         fixed_mod = reg_direction["fixed"]
         moving_mod = reg_direction["moving"]
+        pair = f'{case}_{fixed_mod}<--{case}_{moving_mod}'
         
         # Running NiftyReg 
-        
-        ### Creating Masks: load images, create masks, save masks       
         fixed_path = os.path.join(path_data, f"ReMIND2Reg_{case}_{fixed_mod}.nii.gz") 
-        fixed_img = sitk.ReadImage(fixed_path)
-        fixed_mask = get_mask(fixed_img)
-        fixed_mask_flnm = os.path.join(path_output, 'mask', f'ReMIND2Reg_{case}_{fixed_mod}_mask.nii.gz')
-        sitk.WriteImage(fixed_mask, fixed_mask_flnm)
-        
         moving_path = os.path.join(path_data, f"ReMIND2Reg_{case}_{moving_mod}.nii.gz") 
-        moving_img = sitk.ReadImage(moving_path)
-        moving_mask = get_mask(moving_img)
-        moving_mask_flnm = os.path.join(path_output, 'mask', f'ReMIND2Reg_{case}_{moving_mod}_mask.nii.gz')
-        sitk.WriteImage(moving_mask, moving_mask_flnm)
+        res_filnm = os.path.join(path_output, 'niftyreg', f'ReMIND2Reg_{case}_{fixed_mod}_{case}_{moving_mod}.txt')
         
+        if use_reg_aladin:
+            ### Creating Masks: load images, create masks, save masks       
+            with stage('load', pair=pair):
+                fixed_img = sitk.ReadImage(fixed_path)
+                moving_img = sitk.ReadImage(moving_path)
+                
+                # reg_aladin works in physical space, the cropped images give the same transformation;
+                # they only exist for the reg_aladin call and are removed afterwards
+                fixed_reg_path, moving_reg_path = fixed_path, moving_path
+                fixed_reg_img, moving_reg_img = fixed_img, moving_img
+                roi_dir = None
+                if crop_roi:
+                    roi_dir = tempfile.TemporaryDirectory()
+                    fixed_reg_img, moving_reg_img = crop_foreground(fixed_img, moving_img, roi_margin)
+                    fixed_reg_path = os.path.join(roi_dir.name, f'ReMIND2Reg_{case}_{fixed_mod}_roi.nii.gz')
+                    moving_reg_path = os.path.join(roi_dir.name, f'ReMIND2Reg_{case}_{moving_mod}_roi.nii.gz')
+                    sitk.WriteImage(fixed_reg_img, fixed_reg_path)
+                    sitk.WriteImage(moving_reg_img, moving_reg_path)
+                
+                fixed_mask = get_mask(fixed_reg_img)
+                fixed_mask_flnm = os.path.join(path_output, 'mask', f'ReMIND2Reg_{case}_{fixed_mod}_mask.nii.gz')
+                sitk.WriteImage(fixed_mask, fixed_mask_flnm)
+                
+                moving_mask = get_mask(moving_reg_img)
+                moving_mask_flnm = os.path.join(path_output, 'mask', f'ReMIND2Reg_{case}_{moving_mod}_mask.nii.gz')
+                sitk.WriteImage(moving_mask, moving_mask_flnm)
+            
 
-        ### Excecuting NiftyReg        
-        res_filnm = os.path.join(path_output, 'niftyreg', f'ReMIND2Reg_{case}_{fixed_mod}_{case}_{moving_mod}.txt')
-        res_img = os.path.join(path_output, 'niftyreg', f'ReMIND2Reg_{case}_{moving_mod}_reg.nii.gz')
-        p = "reg_aladin -ref {} -flo {} -rmask {} -fmask {} -noSym -aff {} -res {} -nac -ln 2 -lp 10"
-        os.system(p.format(
-            clean_cmdline(fixed_path),
-            clean_cmdline(moving_path),
-            clean_cmdline(fixed_mask_flnm),
-            clean_cmdline(moving_mask_flnm),
-            clean_cmdline(res_filnm), 
-            clean_cmdline(res_img)
-            )
-        )
+            ### Excecuting NiftyReg        
+            res_img = os.path.join(path_output, 'niftyreg', f'ReMIND2Reg_{case}_{moving_mod}_reg.nii.gz')
+            p = "reg_aladin -ref {} -flo {} -rmask {} -fmask {} -noSym -aff {} -res {} -nac -ln {} -lp {}"
+            with stage('reg_aladin', pair=pair):
+                os.system(p.format(
+                    clean_cmdline(fixed_reg_path),
+                    clean_cmdline(moving_reg_path),
+                    clean_cmdline(fixed_mask_flnm),
+                    clean_cmdline(moving_mask_flnm),
+                    clean_cmdline(res_filnm), 
+                    clean_cmdline(res_img),
+                    aladin_levels['ln'],
+                    aladin_levels['lp'],
+                    )
+                )
+            if roi_dir is not None:
+                roi_dir.cleanup()
+            affine_nifti =  np.loadtxt(res_filnm)
+        else:
+            ### Images and masks stay in memory
+            with stage('load', pair=pair):
+                affine_fix = dataset.header(fixed_path)[0]
+                fixed_array = dataset.load(fixed_path)
+                affine_img = dataset.header(moving_path)[0]
+                moving_array = dataset.load(moving_path)
+                moving_img = image_from_array(moving_array, affine_img)
+                box = foreground_box(fixed_array, moving_array, roi_margin) if crop_roi else tuple(slice(0, s) for s in fixed_array.shape)
+            
+            with stage('aladin', pair=pair):
+                affine_nifti = aladin(fixed_array[box], moving_array[box], crop_affine(affine_fix, box), crop_affine(affine_img, box),
+                                      similarity=similarity, **aladin_levels)
+                np.savetxt(res_filnm, affine_nifti)
         
         # Saving transformation affine as displacement field
         
-        ### Create displacement field in space (mm) RAS
-        affine_nifti =  np.loadtxt(res_filnm)
-        affine_ras = np.linalg.inv(affine_nifti)
-        disp_field_space, transform = create_displacement_field(affine_ras, moving_img)
-        
-        ### Creating displacement field in voxel 
-        moving_nib = nib.load(moving_path)
-        affine_img = moving_nib.affine
-        moving_array = moving_nib.get_fdata()
-        
-        D, H, W = moving_array.shape
-        identity = np.meshgrid(np.arange(D), np.arange(
-            H), np.arange(W), indexing='ij')
-        identity_voxel = np.stack(identity,-1)
-        identity_space = apply_affine(affine_img, identity_voxel)
-        new_space = disp_field_space + identity_space 
-        disp_field_voxel = apply_affine(np.linalg.inv(affine_img), new_space) - identity_voxel
+        with stage('displacement', pair=pair):
+            ### Create displacement field in space (mm) RAS
+            affine_ras = np.linalg.inv(affine_nifti)
+            disp_field_space, transform = create_displacement_field(affine_ras, moving_img)
+            
+            ### Creating displacement field in voxel 
+            affine_img = dataset.header(moving_path)[0]
+            moving_array = dataset.load(moving_path)
+            
+            D, H, W = moving_array.shape
+            identity = np.meshgrid(np.arange(D), np.arange(
+                H), np.arange(W), indexing='ij')
+            identity_voxel = np.stack(identity,-1)
+            identity_space = apply_affine(affine_img, identity_voxel)
+            new_space = disp_field_space + identity_space 
+            disp_field_voxel = apply_affine(np.linalg.inv(affine_img), new_space) - identity_voxel
         
         ### Saving displacement field in voxel
-        dis_filnm = os.path.join(path_output, 'disp', f'disp_{case}_{fixed_mod}_{case}_{moving_mod}.nii.gz')
-        disp_field_img = nib.Nifti1Image(disp_field_voxel.astype(np.float32), affine_img)
-        disp_field_img.to_filename(dis_filnm)
+        with stage('write', pair=pair):
+            dis_filnm = os.path.join(path_output, 'disp', f'disp_{case}_{fixed_mod}_{case}_{moving_mod}.nii.gz')
+            disp_field_img = nib.Nifti1Image(disp_field_voxel.astype(np.float32), affine_img)
+            disp_field_img.to_filename(dis_filnm)
         
         ### Testing
         # Check for L2R evaluation
@@ -0,0 +1,48 @@
+"""
+Regression test of the in-process affine registration (aladin.py) on a synthetic pair with a known affine.
+
+    cd niftyreg && python -m pytest -q test_aladin.py
+"""
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, map_coordinates
+from scipy.spatial.transform import Rotation
+
+from aladin import aladin
+
+
+def synthetic_pair(size=96, seed=0):
+    """Smooth random texture in a ball (fixed) and its image under a known affine T (moving(y) = fixed(T^-1 y))."""
+    rng = np.random.default_rng(seed)
+    texture = gaussian_filter(rng.standard_normal((size,)*3), 3)
+    texture = gaussian_filter((texture > 0).astype(float), 1.5)*100 + gaussian_filter(rng.standard_normal((size,)*3), 1)*10
+    grid = np.stack(np.meshgrid(*[np.arange(size)]*3, indexing='ij'))
+    ball = ((grid - size/2)**2).sum(0) < (0.42*size)**2
+    fixed = np.where(ball, texture + 200, 0).astype(np.float32)
+
+    affine = np.diag([0.5, 0.5, 0.5, 1.])
+    affine[:3, 3] = [-20, -24, -22]
+    T = np.eye(4)
+    T[:3, :3] = Rotation.from_euler('xyz', [4, -3, 5], degrees=True).as_matrix() @ np.diag([1.03, 0.98, 1.0])
+    centre = affine[:3, :3] @ np.full(3, size/2) + affine[:3, 3]
+    T[:3, 3] = centre - T[:3, :3] @ centre + [1.5, -1, 2]
+
+    M = np.linalg.inv(affine) @ np.linalg.inv(T) @ affine
+    points = M[:3, :3] @ grid.reshape(3, -1) + M[:3, 3:]
+    moving = map_coordinates(fixed, points, order=1).reshape(fixed.shape).astype(np.float32)
+    points_mm = affine[:3, :3] @ grid.reshape(3, -1)[:, ball.reshape(-1)] + affine[:3, 3:]
+    return fixed, moving, affine, T, points_mm
+
+
+def mean_error(R, T, points_mm):
+    return np.linalg.norm((R[:3, :3] - T[:3, :3]) @ points_mm + (R[:3, 3:] - T[:3, 3:]), axis=0).mean()
+
+
+@pytest.mark.parametrize('similarity', ['lncc', 'mind'])
+def test_aladin_recovers_known_affine(similarity):
+    fixed, moving, affine, T, points_mm = synthetic_pair()
+    initial = mean_error(np.eye(4), T, points_mm) # 3.13 mm
+    R = aladin(fixed, moving, affine, affine, ln=2, lp=10, similarity=similarity)
+    # measured: 0.14 mm (lncc), 0.13 mm (mind)
+    assert mean_error(R, T, points_mm) < min(0.3, 0.1*initial)